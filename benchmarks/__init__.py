@@ -0,0 +1,16 @@
+"""
+Benchmarks for django-notification.
+
+The suite runs against an in-memory SQLite database, Django's locmem email
+backend and a fake Twilio client, so numbers are reproducible on any machine
+and comparable across commits::
+
+    python -m benchmarks.run --sizes 1,1000 --output before.json
+    git checkout other-branch
+    python -m benchmarks.run --sizes 1,1000 --output after.json
+    python -m benchmarks.compare before.json after.json
+
+``python -m benchmarks.budgets`` checks that the number of queries issued by
+the public entry points does not grow with the number of recipients, notice
+types or notices.
+"""
@@ -0,0 +1,215 @@
+"""
+Query budgets for the public entry points.
+
+Each budget runs an entry point at several sizes (recipients, notice types,
+notices) and fails if the number of queries exceeds what the budget allows
+for that size. Budgets are written so that they do not grow with the size,
+or only grow per chunk of recipients, which is what catches N+1 patterns::
+
+    python -m benchmarks.budgets [--only send_now,notice_settings]
+
+On failure the statements that grew between the smallest and the failing
+size are listed, with literals collapsed.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+from collections import OrderedDict
+
+# sets up Django, so it has to come before anything importing models
+from benchmarks.environment import create_database, reset_database
+
+from django.contrib.sites.models import Site
+from django.test import Client
+from django.urls import reverse
+
+from benchmarks.fakes import fake_twilio
+from benchmarks.fixtures import make_notice_types, make_notices, make_observers, make_users
+from benchmarks.querycount import CaptureQueriesContext, format_statements, query_diff, statement_counts
+from notification import models as notification
+
+# send_now and queue work through their recipients in chunks of this many;
+# the budgets use a small chunk so that crossing chunk boundaries stays cheap
+# to run
+CHUNK_SIZE = 25
+
+BUDGETS = OrderedDict()
+
+
+def budget(name, sizes, limit):
+    """
+    Registers ``func(size)`` as a budget. ``func`` builds its fixture and
+    returns the call to measure, ``limit(size)`` is the number of queries that
+    call may issue.
+    """
+    def decorator(func):
+        BUDGETS[name] = (func, sizes, limit)
+        return func
+    return decorator
+
+
+def chunks(size):
+    return max(1, -(-size // CHUNK_SIZE))
+
+
+# notice type lookup, then per chunk: settings lookup, creation of missing
+# settings and a refetch, profiles, digest settings and saving the notices
+@budget('send_now', sizes=(1, CHUNK_SIZE, 4 * CHUNK_SIZE), limit=lambda n: 2 + 6 * chunks(n))
+def send_now_budget(size):
+    notice_type, = make_notice_types()
+    users = list(make_users(size))
+    return lambda: notification.send_now(users, notice_type.label)
+
+
+# same as send_now plus the observed items query
+@budget('send_observation_notices_for', sizes=(1, CHUNK_SIZE, 4 * CHUNK_SIZE), limit=lambda n: 3 + 6 * chunks(n))
+def send_observation_notices_for_budget(size):
+    notice_type, = make_notice_types()
+    observed = Site.objects.get_current()
+    make_observers(observed, make_users(size), notice_type)
+    return lambda: notification.send_observation_notices_for(observed)
+
+
+# the observers' notice types and one insert, however many observers there are
+@budget('queue_observation_notices_for', sizes=(1, CHUNK_SIZE, 40 * CHUNK_SIZE), limit=lambda n: 2)
+def queue_observation_notices_for_budget(size):
+    notice_type, = make_notice_types()
+    observed = Site.objects.get_current()
+    make_observers(observed, make_users(size), notice_type)
+    return lambda: notification.queue_observation_notices_for(observed)
+
+
+# the watch state of a whole list of objects
+@budget('observing_map', sizes=(1, 10, 100), limit=lambda n: 1)
+def observing_map_budget(size):
+    notice_type, = make_notice_types()
+    observer = make_users(1)[0]
+    sites = [Site.objects.create(domain='site%d.example.com' % i, name='site %d' % i) for i in range(size)]
+    notification.observe_many(sites[::2], [observer], notice_type.label)
+    return lambda: notification.observing_map(sites, observer)
+
+
+# the recipient ids, then one insert per QUEUE_BULK_SIZE batches
+@budget('queue', sizes=(1, CHUNK_SIZE, 40 * CHUNK_SIZE),
+        limit=lambda n: 1 + -(-chunks(n) // notification.QUEUE_BULK_SIZE))
+def queue_budget(size):
+    notice_type, = make_notice_types()
+    users = make_users(size)
+    return lambda: notification.queue(users, notice_type.label)
+
+
+# a deferred audience is stored as it is, whatever its size
+@budget('queue_audience', sizes=(1, CHUNK_SIZE, 40 * CHUNK_SIZE), limit=lambda n: 1)
+def queue_audience_budget(size):
+    notice_type, = make_notice_types()
+    make_users(size)
+    return lambda: notification.queue(notification.UserAudience(is_active=True), notice_type.label)
+
+
+def _view(url_name, method='get', data=None, notice_types=1, notices=0):
+    notice_type = make_notice_types(count=notice_types)[0]
+    viewer = make_users(1, prefix='viewer')[0]
+    make_notices(viewer, notice_type, notices)
+    client = Client()
+    client.force_login(viewer)
+    url = reverse(url_name)
+    return lambda: getattr(client, method)(url, data or {})
+
+
+# session, user, notice types, settings lookup, creation and refetch
+@budget('notice_settings', sizes=(1, 10, 50), limit=lambda n: 6)
+def notice_settings_budget(size):
+    return _view('notification_notice_settings', notice_types=size)
+
+
+# as above plus one update each for switched on and switched off settings
+@budget('notice_settings_post', sizes=(1, 10, 50), limit=lambda n: 8)
+def notice_settings_post_budget(size):
+    data = dict(('benchmark_%d_1' % i, 'on') for i in range(size))
+    return _view('notification_notice_settings', method='post', data=data, notice_types=size)
+
+
+@budget('notices', sizes=(1, 10, 100), limit=lambda n: 3)
+def notices_budget(size):
+    return _view('notification_notices', notices=size)
+
+
+# a repeat view only reads the session and user, the notices come from the
+# cache
+@budget('notices_cached', sizes=(1, 10, 100), limit=lambda n: 2)
+def notices_cached_budget(size):
+    view = _view('notification_notices', notices=size)
+    view()
+    return view
+
+
+# session, user and a single values() query for the page
+@budget('notices_api', sizes=(1, 10, 100), limit=lambda n: 3)
+def notices_api_budget(size):
+    return _view('notification_notices_api', notices=size)
+
+
+# session, user, feed owner, current site, updated date and items
+@budget('feed_for_user', sizes=(1, 10, 100), limit=lambda n: 6)
+def feed_for_user_budget(size):
+    return _view('notification_feed_for_user', notices=size)
+
+
+def check_budget(name):
+    """
+    Returns a list of failure messages for the named budget.
+    """
+    func, sizes, limit = BUDGETS[name]
+    failures = []
+    baseline = None
+    for size in sizes:
+        reset_database()
+        try:
+            with fake_twilio():
+                call = func(size)
+                with CaptureQueriesContext() as queries:
+                    call()
+        except Exception as e:
+            failures.append('%s at size %d raised %s: %s' % (name, size, e.__class__.__name__, e))
+            break
+        if baseline is None:
+            baseline = queries.captured_queries
+        print('%-30s %6d  %4d queries (budget %d)' % (name, size, len(queries), limit(size)), file=sys.stderr)
+        if len(queries) > limit(size):
+            diff = query_diff(baseline, queries.captured_queries)
+            if diff:
+                detail = 'Change from size %d:\n%s' % (sizes[0], diff)
+            else:
+                detail = 'Statements:\n%s' % format_statements(statement_counts(queries.captured_queries))
+            failures.append('%s at size %d issued %d queries, budget is %d. %s' % (
+                name, size, len(queries), limit(size), detail))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the query budgets of the public entry points.')
+    parser.add_argument('--only', default='',
+                        help='comma separated budget names (default: all of %s)' % ', '.join(BUDGETS))
+    options = parser.parse_args(argv)
+    names = [name for name in options.only.split(',') if name] or list(BUDGETS)
+    for name in names:
+        if name not in BUDGETS:
+            parser.error('unknown budget %r' % name)
+
+    create_database()
+    original_chunk_sizes = notification.SEND_CHUNK_SIZE, notification.QUEUE_BATCH_SIZE
+    notification.SEND_CHUNK_SIZE = notification.QUEUE_BATCH_SIZE = CHUNK_SIZE
+    try:
+        failures = []
+        for name in names:
+            failures.extend(check_budget(name))
+    finally:
+        notification.SEND_CHUNK_SIZE, notification.QUEUE_BATCH_SIZE = original_chunk_sizes
+    for failure in failures:
+        print('\n' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,877 @@
+"""
+Behaviour checks for what the budgets and benchmarks do not measure: error
+isolation, languages, priorities and the like. Each check builds its fixture
+and fails with an AssertionError::
+
+    python -m benchmarks.checks [--only raising_receiver,notices_api_limit]
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from email import message_from_string
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# sets up Django, so it has to come before anything importing models
+from benchmarks.environment import create_database, reset_database
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models.signals import post_save
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone, translation
+
+from benchmarks.fakes import fake_twilio, postmark_stub
+from benchmarks.fixtures import make_notice_types, make_notices, make_observers, make_users
+from benchmarks.profiles.models import UserProfile
+from notification import engine, lockfile
+from notification import models as notification
+from notification import views
+
+CHECKS = OrderedDict()
+
+
+def check(name):
+    def decorator(func):
+        CHECKS[name] = func
+        return func
+    return decorator
+
+
+def setting(name, value):
+    return module_setting(notification, name, value)
+
+
+@contextmanager
+def module_setting(module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+@contextmanager
+def raising_once(signal):
+    """
+    Connects a receiver to ``signal`` that raises the first time it is sent
+    and records the users it is sent for after that.
+    """
+    received = []
+
+    def receiver(sender, user, **kwargs):
+        if not received:
+            received.append(None)
+            raise ValueError('receiver failed')
+        received.append(user.pk)
+
+    signal.connect(receiver, weak=False)
+    try:
+        yield received
+    finally:
+        signal.disconnect(receiver)
+
+
+@check('raising_receiver')
+def raising_receiver_check():
+    # a receiver raising for one recipient must not keep the rest of the
+    # batch from being delivered and signalled
+    notice_type, = make_notice_types()
+    users = list(make_users(5))
+    for threads in (0, 2):
+        mail.outbox = []
+        with setting('DELIVERY_THREADS', threads), fake_twilio() as texts:
+            with raising_once(notification.email_sent) as emails, raising_once(notification.sms_sent) as sms:
+                notification.send_now(users, notice_type.label, dedupe=False)
+        assert len(mail.outbox) == 5, 'threads=%d: %d of 5 emails sent' % (threads, len(mail.outbox))
+        assert len(emails) == 5, 'threads=%d: email_sent for %d of 5' % (threads, len(emails))
+        assert len(texts.sent) == 5, 'threads=%d: %d of 5 texts sent' % (threads, len(texts.sent))
+        assert len(sms) == 5, 'threads=%d: sms_sent for %d of 5' % (threads, len(sms))
+
+    with postmark_stub() as stub, raising_once(notification.email_sent) as emails:
+        errors = notification.get_backend('1').deliver([
+            notification.Delivery(user, notice_type, user.email, 'subject', 'body', (), None) for user in users])
+    assert len(stub.emails) == 5, 'postmark: %d of 5 emails sent' % len(stub.emails)
+    assert len(emails) == 5, 'postmark: email_sent for %d of 5' % len(emails)
+    assert errors == [None] * 5, 'postmark: errors %r' % errors
+
+
+@check('raising_receiver_outbox')
+def raising_receiver_outbox_check():
+    # a receiver raising for an accepted message does not make the outbox
+    # send it again
+    notice_type, = make_notice_types()
+    users = list(make_users(3))
+    notification.OutboxMessage.objects.bulk_create([
+        notification.OutboxMessage(medium=medium, recipient=user, notice_type=notice_type, to=to, body='body')
+        for user in users for medium, to in (('1', user.email), ('3', user.userprofile.sms))])
+
+    def receiver(sender, **kwargs):
+        raise ValueError('receiver failed')
+
+    notification.email_sent.connect(receiver, weak=False)
+    notification.sms_sent.connect(receiver, weak=False)
+    # failed messages are due again right away
+    retry_delay = engine.OUTBOX_RETRY_DELAY
+    engine.OUTBOX_RETRY_DELAY = 0
+    try:
+        with fake_twilio() as texts:
+            engine.send_outbox()
+    finally:
+        engine.OUTBOX_RETRY_DELAY = retry_delay
+        notification.email_sent.disconnect(receiver)
+        notification.sms_sent.disconnect(receiver)
+    assert len(mail.outbox) == 3, '%d emails sent for 3 messages' % len(mail.outbox)
+    assert len(texts.sent) == 3, '%d texts sent for 3 messages' % len(texts.sent)
+    statuses = sorted(set(notification.OutboxMessage.objects.values_list('status', 'attempts')))
+    assert statuses == [(notification.OUTBOX_SENT, 1)], 'messages ended as %r' % statuses
+
+
+@check('dedupe')
+def dedupe_check():
+    # repeats within the window are dropped, repeats after it are not, and a
+    # send that failed is not taken for a duplicate when it is retried
+    notice_type, = make_notice_types()
+    users = list(make_users(3))
+    context = {'users': User.objects.filter(username__startswith='user')}
+    with setting('DEDUPE_WINDOW', 60), fake_twilio():
+        notification.send_now(users, notice_type.label, context)
+        make_users(1, prefix='userlater')
+        notification.send_now(users, notice_type.label, context)
+        assert len(mail.outbox) == 3, 'repeat: %d emails for 3 users' % len(mail.outbox)
+
+        notification.SentNoticeKey.objects.update(added=timezone.now() - timedelta(seconds=61))
+        notification.send_now(users, notice_type.label, context)
+        assert len(mail.outbox) == 6, 'after the window: %d emails for 6 notices' % len(mail.outbox)
+
+        mail.outbox = []
+        bulk_create = notification.Notice.objects.bulk_create
+
+        def failing_bulk_create(*args, **kwargs):
+            raise DatabaseError('insert failed')
+
+        notification.Notice.objects.bulk_create = failing_bulk_create
+        try:
+            notification.send_now(users, notice_type.label, {'retry': True})
+        except DatabaseError:
+            pass
+        finally:
+            notification.Notice.objects.bulk_create = bulk_create
+        assert not mail.outbox, 'a failed send delivered %d emails' % len(mail.outbox)
+        notification.send_now(users, notice_type.label, {'retry': True})
+        assert len(mail.outbox) == 3, 'retry: %d emails for 3 users' % len(mail.outbox)
+
+
+@check('message_store')
+def message_store_check():
+    # message stays a field of its own with the store off; with it on, equal
+    # texts share one row, which is deleted once no notice points to it
+    notice_type, = make_notice_types()
+    users = list(make_users(3))
+    with fake_twilio():
+        notification.send_now(users, notice_type.label, dedupe=False)
+        text = notification.Notice.objects.values_list('message', flat=True).order_by('message').first()
+        assert text, 'no notice text'
+        assert notification.Notice.objects.filter(message=text).count() == 3, 'message lookup failed'
+        with setting('MESSAGE_STORE', True):
+            notification.send_now(users, notice_type.label, dedupe=False)
+            notification.send_now(users, notice_type.label, dedupe=False)
+    stored = notification.Notice.objects.filter(body__isnull=False)
+    assert stored.count() == 6, '%d of 6 notices stored' % stored.count()
+    assert notification.NoticeMessage.objects.count() == 1, \
+        '%d stored messages for one text' % notification.NoticeMessage.objects.count()
+    assert set(notice.message for notice in stored.only('pk', 'body')) == set([text]), 'stored texts differ'
+    assert notification.NoticeMessage.objects.delete_unused() == 0, 'a message in use was deleted'
+    stored.delete()
+    assert notification.NoticeMessage.objects.delete_unused() == 1, 'the unused message was kept'
+
+
+@check('notice_post_save')
+def notice_post_save_check():
+    # post_save receivers for Notice get every saved notice, whether the
+    # database returns the keys of bulk inserted rows or not
+    notice_type, = make_notice_types()
+    users = list(make_users(3))
+    saved = []
+    receiver = lambda sender, instance, created, **kwargs: saved.append((instance.pk, created))
+    post_save.connect(receiver, sender=notification.Notice, weak=False)
+    try:
+        with fake_twilio():
+            notification.send_now(users, notice_type.label)
+    finally:
+        post_save.disconnect(receiver, sender=notification.Notice)
+    pks = set(notification.Notice.objects.values_list('pk', flat=True))
+    assert len(pks) == 3 and set(saved) == set((pk, True) for pk in pks), 'post_save sent for %r' % saved
+
+
+@check('digests_through_backend')
+def digests_through_backend_check():
+    # digests go out through the email medium's backend, with email_sent for
+    # every notice type they cover
+    notice_types = make_notice_types(count=2)
+    users = list(make_users(3))
+    notification.DigestItem.objects.bulk_create([
+        notification.DigestItem(user=user, notice_type=notice_type, frequency='daily', subject='s', message='m')
+        for user in users for notice_type in notice_types])
+    signalled = []
+    receiver = lambda sender, user, notice_type, **kwargs: signalled.append((user.pk, notice_type.pk))
+    notification.email_sent.connect(receiver, weak=False)
+    try:
+        with postmark_stub() as stub:
+            engine.send_digests('daily')
+    finally:
+        notification.email_sent.disconnect(receiver)
+    assert len(stub.emails) == 3, '%d of 3 digests sent through the backend' % len(stub.emails)
+    assert not mail.outbox, 'digests bypassed the backend'
+    assert len(set(signalled)) == 6, 'email_sent for %d of 6 notice types' % len(set(signalled))
+    assert not notification.DigestItem.objects.exists(), 'delivered digest items were kept'
+
+
+@check('postmark_retries')
+def postmark_retries_check():
+    # a batch is posted again only when the kept alive connection turned out
+    # to be closed, never after a timeout
+    notice_type, = make_notice_types()
+    deliveries = [notification.Delivery(user, notice_type, user.email, 'subject', 'body', (), None)
+                  for user in make_users(3)]
+
+    with postmark_stub(drop=True) as stub:
+        for attempt in range(3):
+            errors = notification.get_backend('1').deliver(deliveries)
+            assert errors == [None] * 3, 'closed connection, attempt %d: errors %r' % (attempt, errors)
+    assert len(stub.batches) == 3, 'closed connection: %d batches received for 3 sent' % len(stub.batches)
+
+    with postmark_stub(delay=1, timeout=0.2) as stub:
+        errors = notification.get_backend('1').deliver(deliveries)
+        time.sleep(1.5)
+    assert all(error is not None for error in errors), 'timeout: errors %r' % errors
+    assert len(stub.batches) == 1, 'timeout: %d batches received for 1 sent' % len(stub.batches)
+
+
+@check('postmark_pool_connections')
+def postmark_pool_connections_check():
+    # the connections the delivery threads open are closed as the threads
+    # exit, not left to the garbage collector
+    notice_type, = make_notice_types()
+    users = make_users(3)
+    opened = []
+    with setting('DELIVERY_THREADS', 2), fake_twilio(), postmark_stub() as stub:
+        backend = notification.get_backend('1')
+        original_connection = backend.connection
+
+        def connection():
+            opened.append(original_connection())
+            return opened[-1]
+
+        backend.connection = connection
+        notification.send_now(users, notice_type.label, dedupe=False)
+    assert len(stub.emails) == 3, '%d of 3 emails sent' % len(stub.emails)
+    left_open = len(set(c for c in opened if c.sock is not None))
+    assert opened and not left_open, '%d connections left open by the delivery threads' % left_open
+
+
+@check('attachments')
+def attachments_check():
+    # a tuple and a file attachment, mapped or read, reach every recipient
+    # intact, through the mail backend and in the Postmark payload
+    notice_type, = make_notice_types()
+    users = make_users(2)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'report.pdf')
+    content = os.urandom(3000)
+    with open(path, 'wb') as f:
+        f.write(content)
+    attachments = [('notes.txt', u'caf\xe9', 'text/plain'), path]
+    expected = {
+        'notes.txt': ('text/plain', u'caf\xe9'.encode('utf-8')),
+        'report.pdf': ('application/pdf', content),
+    }
+    try:
+        with fake_twilio():
+            for mmap_size in (1024, 1024 * 1024):
+                with setting('ATTACHMENT_MMAP_SIZE', mmap_size):
+                    notification.send_now(users, notice_type.label, attachments=attachments, dedupe=False)
+                    with postmark_stub() as stub:
+                        notification.send_now(users, notice_type.label, attachments=attachments, dedupe=False)
+                for message in mail.outbox:
+                    parts = message_from_string(message.message().as_string()).walk()
+                    found = dict((part.get_filename(), (part.get_content_type(), part.get_payload(decode=True)))
+                                 for part in parts if part.get_filename())
+                    assert found == expected, 'mail, mmap size %d: attachments %r' % (mmap_size, sorted(found))
+                for email in stub.emails:
+                    found = dict((attachment['Name'], (attachment['ContentType'],
+                                                       base64.b64decode(attachment['Content'])))
+                                 for attachment in email.get('Attachments', ()))
+                    assert found == expected, 'postmark, mmap size %d: attachments %r' % (mmap_size, sorted(found))
+                assert len(mail.outbox) == 2 and len(stub.emails) == 2, \
+                    'mmap size %d: %d emails and %d postmark emails for 2 users' % (
+                        mmap_size, len(mail.outbox), len(stub.emails))
+                mail.outbox = []
+    finally:
+        shutil.rmtree(directory)
+
+
+@check('queue_stats')
+def queue_stats_check():
+    # the backlog is counted per label without reading a pickled batch, and
+    # the command reports the same figures
+    first, second = make_notice_types(2)
+    users = make_users(3)
+    notification.queue(users, first.label)
+    notification.queue(users[:2], second.label, eta=timezone.now() + timedelta(hours=1))
+    notification.queue(notification.UserAudience(), second.label)
+    notification.NoticeQueueBatch.objects.filter(label=first.label).update(
+        added=timezone.now() - timedelta(hours=2))
+    with CaptureQueriesContext(connection) as queries:
+        stats = notification.NoticeQueueBatch.objects.stats()
+    unpickled = [query['sql'] for query in queries if 'pickled_data' in query['sql']]
+    assert not unpickled, 'batches read for the statistics: %r' % unpickled
+    assert (stats['batches'], stats['due'], stats['recipients']) == (3, 2, 5), 'totals %r' % stats
+    assert 7190 < stats['oldest_age'] < 7300, 'oldest age %r' % stats['oldest_age']
+    labels = dict((row['label'], (row['batches'], row['recipients'])) for row in stats['labels'])
+    assert labels == {first.label: (1, 3), second.label: (2, 2)}, 'per label %r' % labels
+    output = StringIO()
+    call_command('notification_queue_stats', json=True, stdout=output)
+    reported = json.loads(output.getvalue())
+    assert (reported['batches'], reported['due'], reported['recipients']) == (3, 2, 5), \
+        'command totals %r' % reported
+    assert len(reported['labels']) == 2, 'command labels %r' % reported['labels']
+
+
+@check('recipient_languages')
+def recipient_languages_check():
+    # every recipient is rendered in their own language, or in the one
+    # send_now was called in when they have none, whatever the order and
+    # wherever the rendering happens
+    notification.create_notice_type('language_check', 'Language check', 'renders the active language', default=3,
+                                    verbosity=0)
+    users = list(make_users(3))
+    UserProfile.objects.filter(user=users[2]).update(language='fr')
+    for processes in (0, 2):
+        reset_inboxes()
+        with setting('RENDER_PROCESSES', processes), setting('RENDER_MIN_RECIPIENTS', 1), \
+                override_settings(NOTIFICATION_LANGUAGE_MODULE='profiles.UserProfile'), \
+                translation.override('en-us'), fake_twilio():
+            notification.send_now(users, 'language_check', dedupe=False)
+        notices = [notice.message for notice in notification.Notice.objects.order_by('recipient')]
+        subjects = [message.subject for message in sorted(mail.outbox, key=lambda message: message.to)]
+        assert notices == ['en-us', 'en-us', 'fr'], 'processes=%d: notices in %r' % (processes, notices)
+        assert [subject.split()[-1] for subject in subjects] == ['en-us', 'en-us', 'fr'], \
+            'processes=%d: subjects %r' % (processes, subjects)
+
+
+@check('send_all_batches')
+def send_all_batches_check():
+    # the drainer sends a batch with one send_now, so delivery threads are
+    # started once per batch rather than once per recipient
+    notice_type, = make_notice_types()
+    users = make_users(50)
+    notification.queue(users, notice_type.label)
+    starts = []
+    original_start = threading.Thread.start
+
+    def start(thread):
+        starts.append(thread.name)
+        original_start(thread)
+
+    threading.Thread.start = start
+    try:
+        with setting('DELIVERY_THREADS', 4), fake_twilio():
+            engine.send_all()
+    finally:
+        threading.Thread.start = original_start
+    delivery_threads = [name for name in starts if name.startswith('notification-delivery')]
+    assert len(mail.outbox) == 50, '%d of 50 emails sent' % len(mail.outbox)
+    assert len(delivery_threads) == 4, '%d delivery threads started for one batch' % len(delivery_threads)
+
+
+@check('send_all_render_processes')
+def send_all_render_processes_check():
+    # a drained batch is large enough to be rendered in the render processes
+    notice_type, = make_notice_types()
+    users = make_users(150)
+    notification.queue(users, notice_type.label)
+    pooled = []
+    original_render = notification.RenderPool.render
+
+    def render(pool, jobs):
+        if pool.processes and len(jobs) >= notification.RENDER_MIN_RECIPIENTS:
+            pooled.extend(jobs)
+        return original_render(pool, jobs)
+
+    notification.RenderPool.render = render
+    try:
+        with setting('RENDER_PROCESSES', 2), setting('DELIVERY_THREADS', 2), fake_twilio():
+            engine.send_all()
+    finally:
+        notification.RenderPool.render = original_render
+    assert len(pooled) == 150, '%d of 150 notices rendered in the render processes' % len(pooled)
+    assert len(mail.outbox) == 150, '%d of 150 emails sent' % len(mail.outbox)
+
+
+@check('render_processes_script')
+def render_processes_script_check():
+    # the render processes set Django up themselves, so they work from a
+    # manage.py-like script, and are started once for all sends
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    process = subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(root, 'benchmarks', 'render_script.py')],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode('utf-8', 'replace')
+    expected = '%d emails, shared render processes' % (2 * notification.RENDER_MIN_RECIPIENTS)
+    assert process.returncode == 0 and output.strip().endswith(expected), 'render_script.py said:\n' + output
+
+
+@check('notices_api_limit')
+def notices_api_limit_check():
+    # out of range limits are rejected, not turned into a server error
+    notice_type, = make_notice_types()
+    viewer = make_users(1, prefix='viewer')[0]
+    make_notices(viewer, notice_type, 3)
+    client = Client()
+    client.force_login(viewer)
+    url = reverse('notification_notices_api')
+    for limit, status in (('0', 400), ('-1', 400), ('x', 400), ('1', 200), ('1000000', 200)):
+        response = client.get(url, {'limit': limit})
+        assert response.status_code == status, 'limit=%s: status %d' % (limit, response.status_code)
+
+
+@check('notices_api_etag')
+def notices_api_etag_check():
+    # a repeated request is answered with a 304 until the inbox changes, and
+    # gets no ETag when the cache keeps no inbox version to derive it from
+    notice_type, = make_notice_types()
+    viewer = make_users(1, prefix='viewer')[0]
+    client = Client()
+    client.force_login(viewer)
+    url = reverse('notification_notices_api')
+    etag = client.get(url)['ETag']
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304, 'no 304 for an unchanged inbox'
+    make_notices(viewer, notice_type, 1)
+    notification.inbox_changed([viewer.pk])
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200, '304 for a changed inbox'
+    with setting('CACHE', 'dummy'):
+        response = client.get(url)
+    assert response.status_code == 200 and not response.has_header('ETag'), \
+        'dummy cache: status %d, ETag %r' % (response.status_code, response.get('ETag'))
+
+
+@check('audience_yields_to_priority')
+def audience_yields_to_priority_check():
+    # a large audience is emitted chunk by chunk, and a high priority batch
+    # queued meanwhile goes out after the current chunk, not after the
+    # whole audience
+    notice_type, = make_notice_types()
+    users = list(make_users(6))
+    vip = make_users(1, prefix='vip')[0]
+    notification.queue(notification.UserAudience(username__startswith='user'), notice_type.label,
+                       priority=notification.PRIORITY_LOW)
+    queued = []
+
+    def queue_urgent(sender, user, **kwargs):
+        if not queued:
+            queued.append(user)
+            notification.queue([vip], notice_type.label, priority=notification.PRIORITY_HIGH)
+
+    notification.email_sent.connect(queue_urgent, weak=False)
+    try:
+        with setting('QUEUE_BATCH_SIZE', 2), fake_twilio():
+            engine.send_all()
+    finally:
+        notification.email_sent.disconnect(queue_urgent)
+    recipients = [message.to[0] for message in mail.outbox]
+    expected = [user.email for user in users[:2]] + [vip.email] + [user.email for user in users[2:]]
+    assert recipients == expected, 'sent in the order %r' % recipients
+    assert not notification.NoticeQueueBatch.objects.exists(), 'batches left in the queue'
+
+
+@check('outbox_claims')
+def outbox_claims_check():
+    # a worker claiming the same rows between another worker's read and its
+    # lease gets them, and the other worker does not
+    notice_type, = make_notice_types()
+    notification.OutboxMessage.objects.bulk_create([
+        notification.OutboxMessage(medium='1', recipient=user, notice_type=notice_type, to=user.email, body='body')
+        for user in make_users(5)])
+    claims = []
+
+    def claim_first(execute, sql, params, many, context):
+        if not claims and sql.startswith('UPDATE') and notification.OutboxMessage._meta.db_table in sql:
+            claims.append(None)
+            claims[0] = [message.pk for message in engine.claim_outbox_batch()]
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(claim_first):
+        claims.append([message.pk for message in engine.claim_outbox_batch()])
+    first, second = claims
+    assert len(first) == 5, 'the first claim got %d of 5 messages' % len(first)
+    assert not set(first) & set(second), 'messages %r claimed twice' % sorted(set(first) & set(second))
+
+
+@check('outbox_lease_renewed')
+def outbox_lease_renewed_check():
+    # a medium's messages are leased again before they are delivered, and
+    # are not delivered when another worker claimed them after the lease
+    # ran out during the delivery of another medium
+    notice_type, = make_notice_types()
+    users = list(make_users(3))
+    notification.OutboxMessage.objects.bulk_create([
+        notification.OutboxMessage(medium=medium, recipient=user, notice_type=notice_type, to=to, body='body')
+        for user in users for medium, to in (('1', user.email), ('3', user.userprofile.sms))])
+    get_backend = notification.get_backend
+    stolen, leases = [], []
+
+    class Backend(object):
+        def __init__(self, medium):
+            self.backend = get_backend(medium)
+            self.medium = medium
+
+        def deliver(self, deliveries):
+            leases.append(set(notification.OutboxMessage.objects.filter(
+                medium=self.medium).values_list('next_attempt', flat=True)))
+            if not stolen:
+                # the other medium's lease runs out and another worker
+                # claims its messages
+                others = notification.OutboxMessage.objects.exclude(medium=self.medium)
+                others.update(next_attempt=timezone.now() - timedelta(seconds=1))
+                stolen.extend(message.pk for message in engine.claim_outbox_batch())
+            return self.backend.deliver(deliveries)
+
+    with fake_twilio() as texts, module_setting(notification, 'get_backend', Backend):
+        start = timezone.now()
+        engine.send_outbox()
+    assert len(stolen) == 3, '%d of 3 messages claimed by the other worker' % len(stolen)
+    assert len(mail.outbox) + len(texts.sent) == 3, \
+        '%d emails and %d texts sent, the claimed messages were sent too' % (len(mail.outbox), len(texts.sent))
+    assert len(leases) == 1 and all(lease > start + timedelta(seconds=engine.OUTBOX_LEASE / 2)
+                                     for lease in leases[0]), 'leases %r' % leases
+
+
+@check('inbox_cache')
+def inbox_cache_check():
+    # the cached notice list is rebuilt after every change to the viewer's
+    # notices, and only then
+    notice_type, = make_notice_types()
+    viewer, other = make_users(2)
+    make_notices(viewer, notice_type, 2)
+    client = Client()
+    client.force_login(viewer)
+    url = reverse('notification_notices')
+
+    def view(cached=False):
+        with CaptureQueriesContext(connection) as queries:
+            notices = client.get(url).context['notices']
+        read = [query['sql'] for query in queries if notification.Notice._meta.db_table in query['sql']]
+        assert not cached or not read, 'notices read for an unchanged inbox: %r' % read
+        return sorted((notice.pk, notice.unseen) for notice in notices)
+
+    assert len(view()) == 2, 'first view'
+    assert len(view(cached=True)) == 2, 'repeat view'
+    notification.Notice.objects.create(recipient=other, notice_type=notice_type, message='new', on_site=True)
+    assert len(view(cached=True)) == 2, "after another user's notice"
+    notification.Notice.objects.create(recipient=viewer, notice_type=notice_type, message='new', on_site=True)
+    assert len(view()) == 3, 'after a new notice'
+    notice = notification.Notice.objects.filter(recipient=viewer).earliest('pk')
+    notice.unseen = False
+    notice.save()
+    assert (notice.pk, False) in view(), 'after a notice was saved'
+    deleted = notice.pk
+    notice.delete()
+    assert deleted not in dict(view()), 'after a notice was deleted'
+    client.get(reverse('notification_mark_all_seen'))
+    assert not any(unseen for pk, unseen in view()), 'after all were marked seen'
+    assert len(view(cached=True)) == 2, 'repeat view after the changes'
+
+
+@check('notice_counts')
+def notice_counts_check():
+    # the counts per notice type take one query, come from the cache while
+    # the inbox is unchanged and follow every change
+    first, second = make_notice_types(2)
+    viewer, = make_users(1)
+    make_notices(viewer, first, 3)
+    make_notices(viewer, second, 1)
+
+    def counts(queries, **kwargs):
+        with CaptureQueriesContext(connection) as captured:
+            result = notification.Notice.objects.counts_for(viewer, **kwargs)
+        assert len(captured) == queries, '%d queries for the counts, expected %d' % (len(captured), queries)
+        return dict((label, (count['unseen'], count['total'])) for label, count in result.items())
+
+    expected = {first.label: (3, 3), second.label: (1, 1)}
+    found = counts(1)
+    assert found == expected, 'counts %r' % found
+    found = counts(0)
+    assert found == expected, 'cached counts %r' % found
+    notification.Notice.objects.filter(recipient=viewer, notice_type=first).update(on_site=False)
+    notification.inbox_changed([viewer.pk])
+    found = counts(1, on_site=True)
+    assert found == {second.label: (1, 1)}, 'on-site counts %r' % found
+    found = counts(1)
+    assert found == expected, 'counts after on_site was changed %r' % found
+    with fake_twilio():
+        notification.send_now([viewer], second.label, dedupe=False)
+    expected[second.label] = (2, 2)
+    found = counts(1)
+    assert found == expected, 'counts after a send %r' % found
+    client = Client()
+    client.force_login(viewer)
+    seen = notification.Notice.objects.filter(recipient=viewer, notice_type=first).values_list('pk', flat=True)
+    client.post(reverse('notification_notices_api'), {'seen': ','.join(map(str, seen))})
+    expected[first.label] = (0, 3)
+    found = counts(1)
+    assert found == expected, 'counts after notices were marked seen %r' % found
+
+
+@check('observed_items_unique')
+def observed_items_unique_check():
+    # observing an object again keeps its one observed item, and the
+    # database refuses a duplicate
+    notice_type, = make_notice_types()
+    observer, other = make_users(2)
+    sites = [Site.objects.create(domain='site%d.example.com' % i, name='site %d' % i) for i in range(2)]
+    item = notification.observe(sites[0], observer, notice_type.label)
+    again = notification.observe(sites[0], observer, notice_type.label)
+    assert again.pk == item.pk, 'observe created a second item'
+    created = notification.observe_many(sites, [observer, other], notice_type.label)
+    assert len(created) == 3, 'observe_many created %d of 3 new items' % len(created)
+    notification.observe(sites[0], observer, notice_type.label, signal='post_delete')
+    count = notification.ObservedItem.objects.count()
+    assert count == 5, '%d of 5 observed items' % count
+    try:
+        with transaction.atomic():
+            notification.ObservedItem.objects.create(
+                user=observer, content_type=item.content_type, object_id=sites[0].pk, notice_type=notice_type,
+                signal='post_save')
+    except IntegrityError:
+        pass
+    else:
+        raise AssertionError('a duplicate observed item was saved')
+    deleted = notification.ObservedItem.objects.delete_duplicates()
+    assert deleted == 0, '%d unique observed items deleted as duplicates' % deleted
+
+
+@check('observers_after_commit')
+def observers_after_commit_check():
+    # observers hear about a save once it is committed, never about one that
+    # is rolled back, and through the queue when asked to
+    notice_type, = make_notice_types()
+    site = Site.objects.get_current()
+    make_observers(site, make_users(3), notice_type)
+
+    class Rollback(Exception):
+        pass
+
+    with fake_twilio():
+        try:
+            with transaction.atomic():
+                notification.handle_observations(Site, site)
+                raise Rollback
+        except Rollback:
+            pass
+        assert not mail.outbox, '%d emails for a rolled back save' % len(mail.outbox)
+        with transaction.atomic():
+            notification.handle_observations(Site, site)
+            assert not mail.outbox, '%d emails before the save was committed' % len(mail.outbox)
+        assert len(mail.outbox) == 3, '%d of 3 emails after the commit' % len(mail.outbox)
+        mail.outbox = []
+        with setting('QUEUE_OBSERVATIONS', True):
+            with transaction.atomic():
+                notification.handle_observations(Site, site)
+                assert not notification.NoticeQueueBatch.objects.exists(), 'queued before the commit'
+        batches = notification.NoticeQueueBatch.objects.count()
+        assert batches == 1 and not mail.outbox, '%d batches queued and %d emails sent' % (batches, len(mail.outbox))
+        engine.send_all()
+    assert len(mail.outbox) == 3, '%d of 3 queued emails sent' % len(mail.outbox)
+
+
+@check('unobserved_models')
+def unobserved_models_check():
+    # a save of a model nobody observes costs no query, and observing or no
+    # longer observing it is noticed right away
+    notice_type, = make_notice_types()
+    observer, = make_users(1)
+    site = Site.objects.get_current()
+
+    def handle():
+        with CaptureQueriesContext(connection) as queries:
+            notification.handle_observations(Site, site)
+        return len(queries)
+
+    handle()
+    queries = handle()
+    assert queries == 0, '%d queries for an unobserved model' % queries
+    with fake_twilio():
+        notification.observe(site, observer, notice_type.label)
+        handle()
+        assert len(mail.outbox) == 1, 'observe: %d of 1 emails' % len(mail.outbox)
+        notification.stop_observing(site, observer)
+        handle()
+        queries = handle()
+        assert queries == 0 and len(mail.outbox) == 1, 'stop_observing: %d queries, %d emails' % (
+            queries, len(mail.outbox))
+        notification.observe_many([site], [observer], notice_type.label)
+        handle()
+        assert len(mail.outbox) == 2, 'observe_many: %d of 2 emails' % len(mail.outbox)
+        notification.stop_observing_many([site], [observer])
+        handle()
+        queries = handle()
+        assert queries == 0 and len(mail.outbox) == 2, 'stop_observing_many: %d queries, %d emails' % (
+            queries, len(mail.outbox))
+
+
+@check('inbox_version_lost')
+def inbox_version_lost_check():
+    # a cache that keeps no inbox version makes every read see a change,
+    # instead of no change ever
+    notice_type, = make_notice_types()
+    viewer = make_users(1, prefix='viewer')[0]
+    client = Client()
+    client.force_login(viewer)
+    url = reverse('notification_notices_api')
+    with setting('CACHE', 'dummy'):
+        assert notification.get_inbox_version(viewer) is not None, 'no inbox version'
+        etag = client.get(url).get('ETag')
+        make_notices(viewer, notice_type, 2)
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag or '*')
+        assert response.status_code == 200, 'api: status %d after new notices' % response.status_code
+        assert len(json.loads(response.content.decode('utf-8'))['notices']) == 2, 'api: new notices missing'
+        counts = notification.Notice.objects.counts_for(viewer)
+        assert counts[notice_type.label]['unseen'] == 2, 'counts: %r' % counts
+        with module_setting(views, 'STREAM_TIMEOUT', 0.5), module_setting(views, 'STREAM_POLL_INTERVAL', 0.1):
+            events = ''.join(views._notice_events(viewer, 0))
+    assert events.count('event: notice') == 2, 'stream: %d of 2 notice events' % events.count('event: notice')
+
+
+@check('flock_holder')
+def flock_holder_check():
+    # the lock is exclusive between processes and goes away with a holder
+    # that dies without releasing it
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'send_notices')
+    holder = subprocess.Popen(
+        [sys.executable, '-c', 'import sys, time\n'
+                               'from notification.lockfile import FlockFileLock\n'
+                               'FlockFileLock(sys.argv[1]).acquire()\n'
+                               'print("locked")\n'
+                               'sys.stdout.flush()\n'
+                               'time.sleep(60)\n', path],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)), stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline().strip() == b'locked', 'the holder did not get the lock'
+        lock = lockfile.FlockFileLock(path)
+        assert lock.is_locked() and not lock.i_am_locking(), 'the lock of the holder is not seen'
+        for timeout in (0, 0.2):
+            try:
+                lock.acquire(timeout=timeout)
+            except (lockfile.AlreadyLocked, lockfile.LockTimeout):
+                pass
+            else:
+                raise AssertionError('acquired the lock with timeout %s while it is held' % timeout)
+        holder.kill()
+        holder.wait()
+        lock.acquire(timeout=1)
+        assert lock.i_am_locking(), 'the lock of the dead holder was not released'
+        lock.release()
+    finally:
+        if holder.poll() is None:
+            holder.kill()
+            holder.wait()
+        holder.stdout.close()
+        shutil.rmtree(directory)
+
+
+@check('flock_keeps_alarm')
+def flock_keeps_alarm_check():
+    # waiting for the lock leaves the caller's own alarm and its handler
+    # as they were
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'send_notices')
+    held = lockfile.FlockFileLock(path)
+    held.acquire()
+    alarms = []
+
+    def on_alarm(signum, frame):
+        alarms.append(signum)
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, 0.5)
+    try:
+        try:
+            lockfile.FlockFileLock(path).acquire(timeout=0.2)
+        except lockfile.LockTimeout:
+            pass
+        else:
+            raise AssertionError('acquired the lock while it is held')
+        assert signal.getsignal(signal.SIGALRM) is on_alarm, 'the alarm handler was replaced'
+        assert signal.getitimer(signal.ITIMER_REAL)[0] > 0, 'the alarm was disarmed'
+        time.sleep(0.5)
+        assert alarms == [signal.SIGALRM], 'the alarm went off %d times' % len(alarms)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        held.release()
+        shutil.rmtree(directory)
+
+
+def reset_inboxes():
+    notification.Notice.objects.all().delete()
+    mail.outbox = []
+
+
+def run_check(name):
+    """
+    Returns the failure message of the named check, or None.
+    """
+    reset_database()
+    try:
+        CHECKS[name]()
+    except Exception:
+        return '%s failed:\n%s' % (name, traceback.format_exc())
+    print('%-30s ok' % name, file=sys.stderr)
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the behaviour of the delivery paths.')
+    parser.add_argument('--only', default='',
+                        help='comma separated check names (default: all of %s)' % ', '.join(CHECKS))
+    options = parser.parse_args(argv)
+    names = [name for name in options.only.split(',') if name] or list(CHECKS)
+    for name in names:
+        if name not in CHECKS:
+            parser.error('unknown check %r' % name)
+
+    create_database()
+    failures = [failure for failure in map(run_check, names) if failure]
+    for failure in failures:
+        print('\n' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Compares two result files written by ``benchmarks.run``.
+
+    python -m benchmarks.compare before.json after.json [--threshold 10]
+
+Exits with status 1 if any benchmark got worse by more than ``threshold``
+percent.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return dict(((r['benchmark'], r['size']), r) for r in report['results'])
+
+
+def change(before, after):
+    """
+    Returns the relative change in percent, positive meaning "better".
+    """
+    if before['higher_is_better']:
+        return (after['value'] - before['value']) / before['value'] * 100
+    return (before['value'] - after['value']) / before['value'] * 100
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage by which a benchmark may get worse (default: 10)')
+    options = parser.parse_args(argv)
+
+    before, after = load(options.before), load(options.after)
+    regressions = 0
+    print('%-22s %8s %14s %14s %9s %9s' % ('benchmark', 'size', 'before', 'after', 'change', 'queries'))
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+        if 'error' in old or 'error' in new:
+            print('%-22s %8d %14s %14s' % (key[0], key[1],
+                                           'error' if 'error' in old else '%.2f' % old['value'],
+                                           'error' if 'error' in new else '%.2f' % new['value']))
+            continue
+        delta = change(old, new)
+        flag = ''
+        if delta < -options.threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print('%-22s %8d %14.2f %14.2f %+8.1f%% %4d->%-4d%s' % (
+            key[0], key[1], old['value'], new['value'], delta, old['queries'], new['queries'], flag))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""
+Sets up Django for the benchmark entry points.
+"""
+import os
+import tempfile
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core import mail  # noqa: E402
+from django.core.cache import caches  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+
+def create_database():
+    setup_test_environment()
+    call_command('migrate', run_syncdb=True, interactive=False, verbosity=0)
+    # engine.send_all() drops its lock file in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='notification-benchmarks-'))
+
+
+def reset_database():
+    call_command('flush', interactive=False, verbosity=0)
+    mail.outbox = []
+    # cached inboxes are keyed by user id, which the next fixture reuses
+    for cache in caches.all():
+        cache.clear()
+    ContentType.objects.clear_cache()
@@ -0,0 +1,135 @@
+"""
+Stand-ins for external services so benchmarks never leave the process.
+"""
+from contextlib import contextmanager
+
+
+class FakeMessages(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def create(self, to, from_, body):
+        self.sent.append((to, from_, body))
+
+
+class FakeTwilioClient(object):
+    """
+    Mimics the small part of ``TwilioRestClient`` that the SMS backend uses.
+    """
+    messages = FakeMessages()
+
+    def __init__(self, account_sid=None, account_token=None):
+        self.api = self
+        self.v2010 = self
+
+
+@contextmanager
+def fake_twilio():
+    from notification.backends import sms
+    original = sms.TwilioRestClient
+    FakeTwilioClient.messages = FakeMessages()
+    sms.TwilioRestClient = FakeTwilioClient
+    try:
+        yield FakeTwilioClient.messages
+    finally:
+        sms.TwilioRestClient = original
+
+
+class PostmarkStub(object):
+    """
+    A local HTTP server answering like Postmark's batch endpoint. It records
+    every batch it receives and rejects the emails to addresses in
+    ``reject``. It answers after ``delay`` seconds, and with ``drop`` set it
+    closes every connection after answering without saying so, like a
+    server timing out an idle kept alive connection.
+    """
+
+    def __init__(self, reject=(), delay=0, drop=False):
+        import json
+        import threading
+        import time
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        stub = self
+        self.batches = []
+        self.connections = 0
+        self.reject = set(reject)
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive between batches
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with lock:
+                    stub.connections += 1
+
+            def do_POST(self):
+                batch = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                with lock:
+                    stub.batches.append(batch)
+                body = json.dumps([
+                    {'ErrorCode': 406, 'Message': 'Inactive recipient', 'To': email['To']}
+                    if email['To'] in stub.reject else
+                    {'ErrorCode': 0, 'Message': 'OK', 'To': email['To'], 'MessageID': str(i)}
+                    for i, email in enumerate(batch)
+                ]).encode('utf-8')
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.close_connection = drop
+
+            def log_message(self, *args):
+                pass
+
+        # one thread per connection, as every delivery thread keeps its own
+        # connection open
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # clients that timed out have gone away before the answer
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/email/batch' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def emails(self):
+        return [email for batch in self.batches for email in batch]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextmanager
+def postmark_stub(reject=(), delay=0, drop=False, timeout=30):
+    """
+    Makes ``send_now`` deliver its emails through the Postmark batch backend
+    to a PostmarkStub, which is yielded. ``timeout`` is the backend's.
+    """
+    from notification import models as notification
+    from notification.backends.postmark import PostmarkBatchBackend
+    stub = PostmarkStub(reject, delay, drop)
+    original = notification.get_backend('1')
+    notification._backends['1'] = PostmarkBatchBackend('1', api_key='stub', url=stub.url, timeout=timeout)
+    try:
+        yield stub
+    finally:
+        notification._backends['1'].close()
+        notification._backends['1'] = original
+        stub.stop()
@@ -0,0 +1,12 @@
+from django.contrib.auth.models import User
+from django.db import models
+
+
+class UserProfile(models.Model):
+    """
+    The profile ``send_now`` expects to find on ``user.userprofile``, and the
+    language store for ``NOTIFICATION_LANGUAGE_MODULE = 'profiles.UserProfile'``.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='userprofile')
+    sms = models.CharField(max_length=20, blank=True)
+    language = models.CharField(max_length=10, blank=True)
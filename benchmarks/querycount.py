@@ -0,0 +1,106 @@
+"""
+Helpers for asserting how many queries a call issues.
+
+``assert_max_queries`` can be used from any test suite::
+
+    with assert_max_queries(5):
+        notification.send_now(users, "friends_invite")
+
+When the budget is exceeded the error lists every statement, with literals
+replaced by ``?`` and repeated statements collapsed, so an N+1 shows up as a
+single line with a large count.
+"""
+import re
+from collections import Counter
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext as BaseCaptureQueriesContext
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\bIN \((?:[^()]+)\)"), "IN (...)"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+]
+
+
+_TRANSACTION_CONTROL = re.compile(r"^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT)\b", re.I)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize(sql):
+    """
+    Replaces literals in ``sql`` so that statements differing only in their
+    parameters compare equal.
+    """
+    for pattern, replacement in _LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def statement_counts(queries):
+    return Counter(normalize(query["sql"]) for query in queries)
+
+
+def format_statements(counts):
+    return "\n".join(
+        "  %5dx %s" % (count, sql) for sql, count in sorted(counts.items(), key=lambda item: -item[1])
+    )
+
+
+def query_diff(baseline, queries):
+    """
+    Returns a readable listing of the statements whose count differs between
+    two captured query lists, e.g. a small and a large run of the same call.
+    """
+    before, after = statement_counts(baseline), statement_counts(queries)
+    lines = []
+    for sql in sorted(set(before) | set(after), key=lambda sql: before[sql] - after[sql]):
+        if before[sql] != after[sql]:
+            lines.append("  %5d -> %-5d %s" % (before[sql], after[sql], sql))
+    return "\n".join(lines)
+
+
+class CaptureQueriesContext(BaseCaptureQueriesContext):
+    """
+    CaptureQueriesContext defaulting to the default database connection and
+    leaving out transaction control statements, which some backends log and
+    others don't.
+    """
+
+    def __init__(self, using=None):
+        super(CaptureQueriesContext, self).__init__(using or connection)
+
+    @property
+    def captured_queries(self):
+        queries = super(CaptureQueriesContext, self).captured_queries
+        return [query for query in queries if not _TRANSACTION_CONTROL.match(query["sql"])]
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def __iter__(self):
+        return iter(self.captured_queries)
+
+    def __getitem__(self, index):
+        return self.captured_queries[index]
+
+
+class assert_max_queries(CaptureQueriesContext):
+    """
+    Context manager raising QueryBudgetExceeded if the block issues more than
+    ``limit`` queries.
+    """
+
+    def __init__(self, limit, name=None, using=None):
+        self.limit = limit
+        self.name = name or "block"
+        super(assert_max_queries, self).__init__(using)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(assert_max_queries, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and len(self) > self.limit:
+            raise QueryBudgetExceeded("%s issued %d queries, budget is %d:\n%s" % (
+                self.name, len(self), self.limit, format_statements(statement_counts(self.captured_queries))))
@@ -0,0 +1,39 @@
+"""
+Sends notices with render processes from a script shaped like ``manage.py``,
+which sets Django up behind its ``__main__`` guard only. The render
+processes import this module again, without running ``main``, so they have
+to set Django up themselves. Run by the ``render_processes_script`` check::
+
+    python benchmarks/render_script.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from benchmarks.environment import create_database
+    from django.core import mail
+
+    from benchmarks.fakes import fake_twilio
+    from benchmarks.fixtures import make_notice_types, make_users
+    from notification import models as notification
+
+    create_database()
+    notice_type, = make_notice_types()
+    users = list(make_users(notification.RENDER_MIN_RECIPIENTS))
+    notification.RENDER_PROCESSES = 2
+    executors = []
+    with fake_twilio():
+        for send in range(2):
+            notification.send_now(users, notice_type.label, dedupe=False)
+            executors.append(notification.get_render_pool().executor)
+    shared = executors[0] is not None and executors[0] is executors[1]
+    print('%d emails, %s render processes' % (len(mail.outbox), 'shared' if shared else 'separate'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
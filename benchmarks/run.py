@@ -0,0 +1,241 @@
+"""
+Runs the benchmark suite and prints (or writes) the results as JSON.
+
+    python -m benchmarks.run [--sizes 1,1000,100000] [--only send_now,queue]
+                             [--repeat 3] [--output results.json]
+
+Throughput benchmarks report ``recipients/s`` (higher is better), view
+benchmarks report the median latency in ``ms`` (lower is better). Every
+result also records the number of queries issued by the measured call.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+# sets up Django, so it has to come before anything importing models
+from benchmarks.environment import create_database, reset_database
+
+import django
+from django.test import Client
+from django.urls import reverse
+
+from benchmarks.fakes import fake_twilio
+from benchmarks.fixtures import make_notice_types, make_notices, make_users
+from benchmarks.querycount import CaptureQueriesContext
+from notification import engine
+from notification import models as notification
+
+DEFAULT_SIZES = '1,1000'
+VIEW_REQUESTS = 20
+# processes of the send_now_render_processes benchmark
+RENDER_PROCESSES = 4
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, unit, higher_is_better=True):
+    def decorator(func):
+        BENCHMARKS[name] = (func, unit, higher_is_better)
+        return func
+    return decorator
+
+
+class Timer(object):
+    """
+    Times a block and counts the queries it issues.
+    """
+
+    def __enter__(self):
+        self.queries = CaptureQueriesContext()
+        self.queries.__enter__()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        self.queries.__exit__(*exc_info)
+        self.query_count = len(self.queries)
+
+
+@benchmark('send_now', 'recipients/s')
+def bench_send_now(size):
+    notice_type, = make_notice_types()
+    users = list(make_users(size))
+    with Timer() as timer:
+        notification.send_now(users, notice_type.label)
+    return [timer]
+
+
+@benchmark('send_now_render_processes', 'recipients/s')
+def bench_send_now_render_processes(size):
+    # the render processes are started once per process, so they are warmed
+    # up before the timed send, like in a long running worker
+    notice_type, = make_notice_types()
+    users = list(make_users(size))
+    original = notification.RENDER_PROCESSES
+    notification.RENDER_PROCESSES = RENDER_PROCESSES
+    try:
+        notification.send_now(make_users(notification.RENDER_MIN_RECIPIENTS, prefix='warmup'), notice_type.label)
+        with Timer() as timer:
+            notification.send_now(users, notice_type.label, dedupe=False)
+    finally:
+        notification.RENDER_PROCESSES = original
+    return [timer]
+
+
+@benchmark('queue', 'recipients/s')
+def bench_queue(size):
+    notice_type, = make_notice_types()
+    users = make_users(size)
+    with Timer() as timer:
+        notification.queue(users, notice_type.label)
+    return [timer]
+
+
+@benchmark('send_all', 'recipients/s')
+def bench_send_all(size):
+    notice_type, = make_notice_types()
+    notification.queue(make_users(size), notice_type.label)
+    with Timer() as timer:
+        engine.send_all()
+    return [timer]
+
+
+def _view_timers(size, url_name):
+    notice_type, = make_notice_types()
+    make_notice_types(count=9, prefix='extra')
+    viewer = make_users(1, prefix='viewer')[0]
+    make_users(max(size - 1, 0))
+    make_notices(viewer, notice_type, size)
+    client = Client()
+    client.force_login(viewer)
+    url = reverse(url_name)
+    # warm up template and URL resolver caches
+    client.get(url)
+    timers = []
+    for i in range(VIEW_REQUESTS):
+        with Timer() as timer:
+            response = client.get(url)
+        if response.status_code != 200:
+            raise AssertionError('%s returned %s' % (url, response.status_code))
+        timers.append(timer)
+    return timers
+
+
+@benchmark('view_notices', 'ms', higher_is_better=False)
+def bench_view_notices(size):
+    return _view_timers(size, 'notification_notices')
+
+
+@benchmark('view_notice_settings', 'ms', higher_is_better=False)
+def bench_view_notice_settings(size):
+    return _view_timers(size, 'notification_notice_settings')
+
+
+@benchmark('view_feed_for_user', 'ms', higher_is_better=False)
+def bench_view_feed_for_user(size):
+    return _view_timers(size, 'notification_feed_for_user')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(name, size, repeat):
+    func, unit, higher_is_better = BENCHMARKS[name]
+    result = OrderedDict([
+        ('benchmark', name),
+        ('size', size),
+        ('unit', unit),
+        ('higher_is_better', higher_is_better),
+    ])
+    timers = []
+    try:
+        for i in range(repeat):
+            reset_database()
+            with fake_twilio():
+                timers.extend(func(size))
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        return result
+    seconds = [timer.seconds for timer in timers]
+    if unit == 'ms':
+        result['value'] = median(seconds) * 1000
+    else:
+        result['value'] = size / max(median(seconds), 1e-9)
+    result['seconds'] = seconds
+    result['queries'] = max(timer.query_count for timer in timers)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the django-notification benchmarks.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated audience sizes (default: %s)' % DEFAULT_SIZES)
+    parser.add_argument('--only', default='',
+                        help='comma separated benchmark names (default: all of %s)' % ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of times to rebuild the fixture and rerun each benchmark')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    options = parser.parse_args(argv)
+
+    sizes = [int(size) for size in options.sizes.split(',') if size]
+    names = [name for name in options.only.split(',') if name] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+
+    create_database()
+
+    results = []
+    for name in names:
+        for size in sizes:
+            result = run_benchmark(name, size, options.repeat)
+            results.append(result)
+            if 'error' in result:
+                print('%-22s %8d  ERROR %s' % (name, size, result['error']), file=sys.stderr)
+            else:
+                print('%-22s %8d  %12.2f %s  (%d queries)' % (
+                    name, size, result['value'], result['unit'], result['queries']), file=sys.stderr)
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('revision', git_revision()),
+            ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('repeat', options.repeat),
+        ])),
+        ('results', results),
+    ])
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SECRET_KEY = 'benchmarks'
+DEBUG = False
+ALLOWED_HOSTS = ['testserver']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.sites',
+    'notification',
+    'benchmarks.profiles',
+]
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+]
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [os.path.join(BENCHMARKS_DIR, 'templates')],
+        'APP_DIRS': True,
+    },
+]
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # keeps nothing, for checking what happens when the cache loses a key
+    'dummy': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+# fast hashing so creating thousands of users is not the thing being measured
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+ROOT_URLCONF = 'benchmarks.urls'
+SITE_ID = 1
+USE_TZ = True
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+DEFAULT_FROM_EMAIL = 'notices@example.com'
+
+TWILIO_ACCOUNT_SID = 'benchmark'
+TWILIO_ACCOUNT_TOKEN = 'benchmark'
+TWILIO_CALLER_ID = '+15550000000'
+
+# errors are recorded in the results, keep tracebacks out of the report
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'loggers': {
+        'django.request': {'level': 'CRITICAL'},
+    },
+}
@@ -1,5 +1,43 @@
 from django.contrib import admin
-from notification.models import NoticeType, NoticeSetting, Notice, ObservedItem, NoticeQueueBatch
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.text import Truncator
+from notification.models import NoticeType, NoticeSetting, Notice, ObservedItem, NoticeQueueBatch, NoticeDigestSetting, \
+    OutboxMessage
+
+# tables with fewer rows than this are counted exactly
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that takes the row count of an unfiltered changelist from the
+    database statistics instead of running COUNT(*), which takes seconds on
+    tables with millions of rows. Filtered changelists, small tables and
+    backends without statistics are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, "query", None)
+        if query is not None and not query.where:
+            estimate = self.estimate(self.object_list.model._meta.db_table, connections[self.object_list.db])
+            if estimate is not None and estimate >= ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    @staticmethod
+    def estimate(table, connection):
+        if connection.vendor == "postgresql":
+            sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+        elif connection.vendor == "mysql":
+            sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else None
 
 class NoticeTypeAdmin(admin.ModelAdmin):
     list_display = ('label', 'display', 'description', 'default')
@@ -7,11 +45,49 @@ class NoticeTypeAdmin(admin.ModelAdmin):
 class NoticeSettingAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'notice_type', 'medium', 'send')
 
+class NoticeDigestSettingAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'notice_type', 'frequency')
+
 class NoticeAdmin(admin.ModelAdmin):
     list_display = ('message', 'recipient', 'sender', 'notice_type', 'added', 'unseen', 'archived')
+    # each filter is backed by an index that also serves the ordering by added
+    list_filter = ('notice_type', 'added', 'unseen')
+    list_select_related = ('recipient', 'sender', 'notice_type', 'body')
+    raw_id_fields = ('recipient', 'sender', 'body')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class NoticeQueueBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'label', 'priority', 'recipient_count', 'not_before', 'added', 'summary')
+    list_filter = ('priority',)
+    exclude = ('pickled_data',)
+    readonly_fields = ('summary',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def summary(self, obj):
+        data = obj.decode()
+        if not isinstance(data, dict):
+            # batches queued before recipients were stored as a list of pks
+            user_ids = [notice[0] for notice in data]
+            data = dict(zip(("label", "extra_context"), data[0][1:3])) if data else {}
+            data["users"] = user_ids
+        if "audience" in data:
+            recipients = repr(data["audience"])
+        else:
+            recipients = "%d users (%s)" % (len(data["users"]), ", ".join(str(pk) for pk in data["users"][:10]))
+        return Truncator("%s to %s, context %r" % (data.get("label"), recipients, data.get("extra_context"))).chars(200)
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'medium', 'recipient', 'notice_type', 'status', 'attempts', 'next_attempt', 'added')
+    list_filter = ('status', 'medium')
+    list_select_related = ('recipient', 'notice_type')
+    raw_id_fields = ('recipient',)
 
-admin.site.register(NoticeQueueBatch)
+admin.site.register(NoticeQueueBatch, NoticeQueueBatchAdmin)
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
+admin.site.register(NoticeDigestSetting, NoticeDigestSettingAdmin)
 admin.site.register(Notice, NoticeAdmin)
 admin.site.register(ObservedItem)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
@@ -31,7 +31,7 @@
 from xml.sax.saxutils import XMLGenerator
 from datetime import datetime
 from django.utils import timezone
-import collections
+from django.utils.encoding import force_text
 
 
 GENERATOR_TEXT = 'django-atompub'
@@ -49,7 +49,7 @@ class SimplerXMLGenerator(XMLGenerator):
         if attrs is None: attrs = {}
         self.startElement(name, attrs)
         if contents is not None:
-            self.characters(contents)
+            self.characters(force_text(contents))
         self.endElement(name)
 
 
@@ -93,12 +93,12 @@ class Feed(object):
             attr = getattr(self, attname)
         except AttributeError:
             return default
-        if isinstance(attr, collections.Callable):
+        if callable(attr):
             # Check func_code.co_argcount rather than try/excepting the
             # function and catching the TypeError, because something inside
             # the function may raise the TypeError. This technique is more
             # accurate.
-            if hasattr(attr, 'func_code'):
+            if hasattr(attr, '__code__'):
                 argcount = attr.__code__.co_argcount
             else:
                 argcount = attr.__call__.__code__.co_argcount
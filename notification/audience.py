@@ -0,0 +1,78 @@
+"""
+Audiences describe the recipients of a notice without listing them.
+
+``queue`` stores an audience as it is and ``emit_notices`` expands it, so
+queueing a notice for "every user matching X" costs a single insert however
+many users match. Audiences are pickled with the queued batch, so they only
+hold plain values: lookups, content type and object ids, never querysets or
+model instances.
+"""
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+
+class Audience(object):
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def chunks(self, size, after=None):
+        """
+        Yields lists of at most ``size`` users ordered by pk, starting after
+        the pk ``after``. Every chunk is fetched with a keyset query
+        (``pk > last pk``), so the cost of a chunk does not grow with how far
+        into the audience it is.
+        """
+        users = self.get_queryset().order_by("pk")
+        while True:
+            chunk = list((users if after is None else users.filter(pk__gt=after))[:size])
+            if chunk:
+                yield chunk
+            if len(chunk) < size:
+                return
+            after = chunk[-1].pk
+
+    def iterator(self, size):
+        for chunk in self.chunks(size):
+            for user in chunk:
+                yield user
+
+
+class UserAudience(Audience):
+    """
+    Every user matching the given lookups, e.g.
+    ``UserAudience(is_active=True, groups__name="beta")``.
+    """
+
+    def __init__(self, **lookups):
+        self.lookups = lookups
+
+    def get_queryset(self):
+        return User.objects.filter(**self.lookups)
+
+    def __repr__(self):
+        return "UserAudience(%s)" % ", ".join("%s=%r" % item for item in sorted(self.lookups.items()))
+
+
+class ObserverAudience(Audience):
+    """
+    Every user observing ``observed`` for ``signal``, optionally only the
+    ones that observe it with the notice type ``label``.
+    """
+
+    def __init__(self, observed, signal="post_save", label=None):
+        self.content_type_id = ContentType.objects.get_for_model(observed).pk
+        self.object_id = observed.pk
+        self.signal = signal
+        self.label = label
+
+    def get_queryset(self):
+        observed_items = apps.get_model("notification", "ObservedItem").objects.filter(
+            content_type=self.content_type_id, object_id=self.object_id, signal=self.signal)
+        if self.label is not None:
+            observed_items = observed_items.filter(notice_type__label=self.label)
+        return User.objects.filter(pk__in=observed_items.values("user"))
+
+    def __repr__(self):
+        return "ObserverAudience(%s:%s, %r, %r)" % (self.content_type_id, self.object_id, self.signal, self.label)
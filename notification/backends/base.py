@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+# a rendered notice on its way to one recipient through one medium
+Delivery = namedtuple("Delivery", "user notice_type to subject body attachments obj")
+
+
+class BaseBackend(object):
+    """
+    Delivers rendered notices through one medium. NOTIFICATION_MEDIA maps
+    every medium to the dotted path of its backend, which is imported and
+    instantiated the first time the medium is used, see get_backend.
+
+    send_now hands ``deliver`` lists of at most ``batch_size`` Deliveries,
+    with the rendered ``format`` as their body. One instance is shared by the
+    threads of a DeliveryPool.
+    """
+    batch_size = 50
+    format = "full.txt"
+
+    def __init__(self, medium):
+        self.medium = medium
+
+    def prefetch(self, users):
+        """
+        Fetches whatever ``address`` needs for a whole chunk of ``users``.
+        """
+        pass
+
+    def address(self, user):
+        """
+        Returns where ``user`` gets notices through this medium, or None if
+        they cannot get them.
+        """
+        raise NotImplementedError
+
+    def deliver(self, deliveries):
+        """
+        Delivers ``deliveries`` and returns a list with an item for each of
+        them: None if it was delivered, otherwise the exception it failed
+        with. Failures are logged, they are not raised. A delivery the
+        provider accepted counts as delivered even when a receiver of
+        ``email_sent`` or ``sms_sent`` raises, since reporting it as failed
+        would have it sent again.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Closes the connections the calling thread opened, called by each
+        DeliveryPool thread as it exits.
+        """
+        pass
+
+
+class OnSiteBackend(BaseBackend):
+    """
+    On-site notices are the Notice rows send_now saves, there is nothing
+    left to deliver.
+    """
+
+    def address(self, user):
+        return None
+
+    def deliver(self, deliveries):
+        return [None] * len(deliveries)
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+
+from notification.backends.base import BaseBackend
+from notification.models import Notice, email_sent, notifications_logger
+
+
+class EmailBackend(BaseBackend):
+    """
+    Sends every notice as its own email through Django's EMAIL_BACKEND,
+    reusing one mail connection for a whole batch.
+    """
+    # send_now renders the subject and HTML body of emails itself
+    format = None
+
+    def address(self, user):
+        return user.email or None
+
+    def deliver(self, deliveries):
+        connection = mail.get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            for delivery in deliveries:
+                self.log_error(delivery)
+            return [e] * len(deliveries)
+        try:
+            return [self.send(delivery, connection) for delivery in deliveries]
+        finally:
+            connection.close()
+
+    def send(self, delivery, connection):
+        # send empty "plain text" data
+        msg = EmailMultiAlternatives(delivery.subject, "", settings.DEFAULT_FROM_EMAIL, [delivery.to],
+                                     connection=connection)
+        # attach html data as alternative
+        msg.attach_alternative(delivery.body, "text/html")
+        for attachment in delivery.attachments:
+            msg.attach(attachment)
+        try:
+            msg.send()
+        except Exception as e:
+            self.log_error(delivery)
+            return e
+        self.delivered(delivery)
+        return None
+
+    def delivered(self, delivery):
+        # the email is out, so a failing receiver is only logged: reporting
+        # the delivery as failed would have it sent again
+        try:
+            email_sent.send(sender=Notice, user=delivery.user, notice_type=delivery.notice_type, obj=delivery.obj)
+        except Exception:
+            notifications_logger.exception(
+                "ERROR:EMAIL_SENT:%s: data=(notice_type=%s, subject=%s)" % (
+                    delivery.user, delivery.notice_type, delivery.subject))
+        notifications_logger.info(
+            "SUCCESS:EMAIL:%s: data=(notice_type=%s, subject=%s)" % (
+                delivery.user, delivery.notice_type, delivery.subject))
+
+    def log_error(self, delivery):
+        notifications_logger.exception(
+            "ERROR:EMAIL:%s: data=(notice_type=%s, subject=%s)" % (
+                delivery.user, delivery.notice_type, delivery.subject))
@@ -0,0 +1,133 @@
+"""
+Delivers notice emails through Postmark's batch API, up to 500 emails per
+HTTP request over a kept alive connection::
+
+    NOTIFICATION_EMAIL_BACKEND = "notification.backends.postmark.PostmarkBatchBackend"
+    POSTMARK_API_KEY = "..."
+    POSTMARK_SENDER = "notices@example.com"  # defaults to DEFAULT_FROM_EMAIL
+
+Set ``NOTIFICATION_POSTMARK_URL`` to send to another endpoint, e.g. a local
+stub server.
+"""
+from __future__ import absolute_import
+
+import errno
+import json
+import threading
+
+from django.conf import settings
+from postmark import PMMail
+
+from notification.backends.email import EmailBackend
+from notification.models import _chunked, notifications_logger
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException, RemoteDisconnected
+    from urllib.parse import urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException, BadStatusLine as RemoteDisconnected
+    from urlparse import urlsplit
+
+POSTMARK_URL = getattr(settings, "NOTIFICATION_POSTMARK_URL", "https://api.postmarkapp.com/email/batch")
+# Postmark accepts at most this many emails per batch
+BATCH_SIZE = 500
+
+
+class PostmarkError(Exception):
+    pass
+
+
+class PostmarkBatchBackend(EmailBackend):
+    """
+    Sends emails in batches and fires ``email_sent`` and logs for each email
+    according to its own result in the batch response.
+
+    Every thread keeps its own connection open between batches, so an
+    instance can be shared by the threads of a DeliveryPool.
+    """
+    batch_size = BATCH_SIZE
+
+    def __init__(self, medium, api_key=None, sender=None, url=None, timeout=30):
+        super(PostmarkBatchBackend, self).__init__(medium)
+        self.api_key = api_key or getattr(settings, "POSTMARK_API_KEY", None)
+        self.sender = sender or getattr(settings, "POSTMARK_SENDER", settings.DEFAULT_FROM_EMAIL)
+        self.url = urlsplit(url or POSTMARK_URL)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            connection_class = HTTPSConnection if self.url.scheme == "https" else HTTPConnection
+            self.local.connection = connection_class(self.url.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def close(self):
+        if getattr(self.local, "connection", None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    def post(self, payload):
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "X-Postmark-Server-Token": self.api_key,
+        }
+        for attempt in (1, 2):
+            connection = self.connection()
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", self.url.path or "/", payload, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (HTTPException, IOError) as e:
+                self.close()
+                # the server may have closed the kept alive connection since
+                # the last batch, in which case it never saw this one; try
+                # again once on a fresh connection. Anything else, timeouts
+                # in particular, may have reached Postmark and is not retried
+                # so that no email goes out twice.
+                if not (attempt == 1 and reused and self.closed_by_server(e)):
+                    raise
+        if response.status != 200:
+            raise PostmarkError("batch rejected with status %s: %s" % (response.status, data[:500]))
+        return json.loads(data.decode("utf-8"))
+
+    @staticmethod
+    def closed_by_server(error):
+        return isinstance(error, RemoteDisconnected) or getattr(error, "errno", None) == errno.EPIPE
+
+    def to_json(self, email):
+        # send_now hands over attachments as MIME parts that are base64
+        # encoded already, PMMail takes their payload as it is
+        return PMMail(api_key=self.api_key, sender=self.sender, to=email.to, subject=email.subject,
+                      html_body=email.body, attachments=list(email.attachments)).to_json_message()
+
+    def deliver(self, emails):
+        errors = []
+        for batch in _chunked(emails, BATCH_SIZE):
+            errors.extend(self.send_batch(batch))
+        return errors
+
+    def send_batch(self, batch):
+        try:
+            results = self.post(json.dumps([self.to_json(email) for email in batch]))
+        except Exception as e:
+            for email in batch:
+                notifications_logger.error(
+                    "ERROR:EMAIL:%s: data=(notice_type=%s, subject=%s, error=%r)" % (
+                        email.user, email.notice_type, email.subject, e))
+            return [e] * len(batch)
+        errors = []
+        # results come back in the order of the batch
+        for email, result in zip(batch, results):
+            if result.get("ErrorCode") == 0:
+                self.delivered(email)
+                errors.append(None)
+            else:
+                notifications_logger.error(
+                    "ERROR:EMAIL:%s: data=(notice_type=%s, subject=%s, error=%s %s)" % (
+                        email.user, email.notice_type, email.subject, result.get("ErrorCode"),
+                        result.get("Message")))
+                errors.append(PostmarkError("%s %s" % (result.get("ErrorCode"), result.get("Message"))))
+        return errors
@@ -0,0 +1,65 @@
+"""
+Sends notices as text messages through Twilio::
+
+    TWILIO_ACCOUNT_SID = "..."
+    TWILIO_ACCOUNT_TOKEN = "..."
+    TWILIO_CALLER_ID = "+15550000000"
+
+Numbers are taken from ``user.userprofile.sms``.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from twilio.rest import TwilioRestClient
+
+from notification.backends.base import BaseBackend
+from notification.models import Notice, notifications_logger, sms_sent
+
+TWILIO_ACCOUNT_SID = getattr(settings, "TWILIO_ACCOUNT_SID", False)
+TWILIO_ACCOUNT_TOKEN = getattr(settings, "TWILIO_ACCOUNT_TOKEN", False)
+TWILIO_CALLER_ID = getattr(settings, "TWILIO_CALLER_ID", False)
+
+
+class TwilioBackend(BaseBackend):
+    """
+    Sends a text message per notice, with one Twilio client for a whole
+    batch.
+    """
+    format = "sms.txt"
+
+    def prefetch(self, users):
+        prefetch_related_objects(users, "userprofile")
+
+    def address(self, user):
+        return user.userprofile.sms or None
+
+    def deliver(self, deliveries):
+        rc = TwilioRestClient(TWILIO_ACCOUNT_SID, TWILIO_ACCOUNT_TOKEN)
+        return [self.send(delivery, rc) for delivery in deliveries]
+
+    def send(self, delivery, rc):
+        try:
+            rc.api.v2010.messages.create(
+                to=delivery.to,
+                from_=TWILIO_CALLER_ID,
+                body=delivery.body,
+            )
+        except Exception as e:
+            notifications_logger.exception(
+                "ERROR:SMS:%s: data=(notice_type=%s, msg=%s)" % (delivery.user, delivery.notice_type, delivery.body))
+            return e
+        self.delivered(delivery)
+        return None
+
+    def delivered(self, delivery):
+        # the message is out, so a failing receiver is only logged:
+        # reporting the delivery as failed would have it sent again
+        try:
+            sms_sent.send(sender=Notice, user=delivery.user, notice_type=delivery.notice_type, obj=delivery.obj)
+        except Exception:
+            notifications_logger.exception(
+                "ERROR:SMS_SENT:%s: data=(notice_type=%s, msg=%s)" % (
+                    delivery.user, delivery.notice_type, delivery.body))
+        notifications_logger.info(
+            "SUCCESS:SMS:%s: data=(notice_type=%s, msg=%s)" % (delivery.user, delivery.notice_type, delivery.body))
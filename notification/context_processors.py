@@ -3,8 +3,10 @@ from notification.models import Notice
 
 def notification(request):
     if request.user.is_authenticated:
+        counts = Notice.objects.counts_for(request.user, on_site=True)
         return {
-            'notice_unseen_count': Notice.objects.unseen_count_for(request.user, on_site=True),
+            'notice_unseen_count': sum(count['unseen'] for count in counts.values()),
+            'notice_counts': counts,
         }
     else:
         return {}
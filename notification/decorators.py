@@ -1,4 +1,3 @@
-import collections
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login
@@ -53,7 +52,7 @@ def basic_auth_required(realm=None, test_func=None, callback_func=None):
                     user = authenticate(username=username, password=password)
                     if user is not None:
                         if user.is_active:
-                            if callback_func is not None and isinstance(callback_func, collections.Callable):
+                            if callback_func is not None and callable(callback_func):
                                 callback_func(request, user, *args, **kwargs)
                             return view_func(request, *args, **kwargs)
 
@@ -1,28 +1,92 @@
 
 import sys
+from datetime import timedelta
 import time
 import logging
 import traceback
-
-try:
-    import pickle as pickle
-except ImportError:
-    import pickle
+from itertools import groupby
 
 from django.conf import settings
 from django.core.mail import mail_admins
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import activate, get_language
 
 from .lockfile import FileLock, AlreadyLocked, LockTimeout
 
-from notification.models import NoticeQueueBatch
+from notification.models import DigestItem, NoticeQueueBatch, OutboxMessage, OUTBOX_FAILED, OUTBOX_PENDING, OUTBOX_SENT
 from notification import models as notification
 
 # lock timeout value. how long to wait for the lock to become available.
 # default behavior is to never wait for the lock to be available.
 LOCK_WAIT_TIMEOUT = getattr(settings, "NOTIFICATION_LOCK_WAIT_TIMEOUT", -1)
 
+# how many outbox messages a worker claims at a time
+OUTBOX_BATCH_SIZE = getattr(settings, "NOTIFICATION_OUTBOX_BATCH_SIZE", 100)
+# seconds a claimed message is hidden from other workers, after which it is
+# retried if the worker that claimed it went away
+OUTBOX_LEASE = getattr(settings, "NOTIFICATION_OUTBOX_LEASE", 300)
+# a failed message is retried after OUTBOX_RETRY_DELAY seconds, doubling
+# with every attempt up to OUTBOX_MAX_RETRY_DELAY, until OUTBOX_MAX_ATTEMPTS
+OUTBOX_RETRY_DELAY = getattr(settings, "NOTIFICATION_OUTBOX_RETRY_DELAY", 60)
+OUTBOX_MAX_RETRY_DELAY = getattr(settings, "NOTIFICATION_OUTBOX_MAX_RETRY_DELAY", 6 * 60 * 60)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, "NOTIFICATION_OUTBOX_MAX_ATTEMPTS", 8)
+# days sent messages are kept for
+OUTBOX_KEEP_DAYS = getattr(settings, "NOTIFICATION_OUTBOX_KEEP_DAYS", 7)
+
+def describe_holder(lock):
+    holder = lock.holder()
+    if holder is None:
+        return "an unknown process"
+    return "pid %s on %s" % holder
+
+def emit_audience_batch(batch, data):
+    """
+    Expands the audience of a deferred batch in keyset chunks and sends each
+    chunk with send_now. The pk of the last user emitted to is saved after
+    every chunk, so a batch interrupted by a crash resumes where it stopped
+    instead of notifying its audience again.
+
+    Returns the number of notices sent and whether the batch is done. It is
+    not done when a batch of higher priority became due meanwhile: that one
+    goes first, and this one resumes after it.
+    """
+    sent = 0
+    for users in data["audience"].chunks(notification.QUEUE_BATCH_SIZE, after=data["after"]):
+        logging.info("emitting notice %s to %s users of %r" % (data["label"], len(users), data["audience"]))
+        notification.send_now(users, data["label"], data["extra_context"], data["on_site"], data["sender"],
+                              dedupe_key=data["dedupe_key"])
+        data["after"] = users[-1].pk
+        NoticeQueueBatch.objects.filter(pk=batch.pk).update(pickled_data=NoticeQueueBatch.encode(data))
+        sent += len(users)
+        if NoticeQueueBatch.objects.due().filter(priority__lt=batch.priority).exists():
+            return sent, False
+    return sent, True
+
+def emit_batch(batch):
+    """
+    Sends the notices of a batch of listed recipients with one send_now call
+    for all recipients sharing a label and context, rather than one per
+    recipient. send_now's chunks, rendering processes and delivery threads
+    then work across the whole batch.
+    """
+    sent = 0
+    for (label, extra_context, on_site, sender), notices in groupby(batch.notices(), key=lambda notice: notice[1:]):
+        user_ids = [notice[0] for notice in notices]
+        users = User.objects.in_bulk(user_ids)
+        for user_id in user_ids:
+            if user_id not in users:
+                # Ignore deleted users, just warn about them
+                logging.warning("not emitting notice %s to user %s since it does not exist" % (label, user_id))
+        logging.info("emitting notice %s to %s users" % (label, len(users)))
+        notification.send_now([users[user_id] for user_id in user_ids if user_id in users], label,
+                              extra_context, on_site, sender, dedupe=False)
+        sent += len(user_ids)
+    return sent
+
 def send_all():
     lock = FileLock("send_notices")
 
@@ -30,10 +94,10 @@ def send_all():
     try:
         lock.acquire(LOCK_WAIT_TIMEOUT)
     except AlreadyLocked:
-        logging.debug("lock already in place. quitting.")
+        logging.debug("lock already held by %s. quitting." % (describe_holder(lock),))
         return
     except LockTimeout:
-        logging.debug("waiting for the lock timed out. quitting.")
+        logging.debug("waiting for the lock held by %s timed out. quitting." % (describe_holder(lock),))
         return
     logging.debug("acquired.")
 
@@ -43,19 +107,21 @@ def send_all():
     try:
         # nesting the try statement to be Python 2.4
         try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                notices = pickle.loads(str(queued_batch.pickled_data).decode("base64"))
-                for user, label, extra_context, on_site, sender in notices:
-                    try:
-                        user = User.objects.get(pk=user)
-                        logging.info("emitting notice %s to %s" % (label, user))
-                        # call this once per user to be atomic and allow for logging to
-                        # accurately show how long each takes.
-                        notification.send_now([user], label, extra_context, on_site, sender)
-                    except User.DoesNotExist:
-                        # Ignore deleted users, just warn about them
-                        logging.warning("not emitting notice %s to user %s since it does not exist" % (label, user))
-                    sent += 1
+            while True:
+                # look for the next batch every time, so that a high priority
+                # batch queued meanwhile goes ahead of the remaining ones
+                queued_batch = NoticeQueueBatch.objects.due().first()
+                if queued_batch is None:
+                    break
+                data = queued_batch.decode()
+                if isinstance(data, dict) and "audience" in data:
+                    emitted, done = emit_audience_batch(queued_batch, data)
+                    sent += emitted
+                    if done:
+                        queued_batch.delete()
+                        batches += 1
+                    continue
+                sent += emit_batch(queued_batch)
                 queued_batch.delete()
                 batches += 1
         except:
@@ -73,6 +139,203 @@ def send_all():
         lock.release()
         logging.debug("released.")
     
+    notification.purge_sent_notice_keys()
+
     logging.info("")
     logging.info("%s batches, %s sent" % (batches, sent,))
     logging.info("done in %.2f seconds" % (time.time() - start_time))
+
+
+def send_digests(frequency):
+    """
+    Sends every user with pending DigestItems of the given frequency a single
+    email summarizing them, rendered from the ``digest_subject.txt`` and
+    ``digest_body.txt`` templates. Items added while this runs are left for
+    the next run.
+
+    The digests go out through the email medium's backend, in batches of its
+    ``batch_size``.
+    """
+    import pynliner
+
+    backend = notification.get_backend("1")
+    current_site = Site.objects.get_current()
+    current_language = get_language()
+    pending = DigestItem.objects.filter(frequency=frequency, added__lte=timezone.now())
+    user_ids = list(pending.order_by().values_list("user", flat=True).distinct())
+    users, sent = 0, 0
+    start_time = time.time()
+
+    digests = []
+    for user in User.objects.filter(pk__in=user_ids).iterator():
+        items = list(pending.filter(user=user).select_related("notice_type"))
+        to = user.is_active and backend.address(user)
+        if not to:
+            DigestItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+            continue
+        try:
+            activate(notification.get_notification_language(user))
+        except notification.LanguageStoreNotAvailable:
+            activate(current_language)
+        context = {
+            "recipient": user,
+            "items": items,
+            "frequency": frequency,
+            "notices_url": "",
+            "current_site": current_site,
+        }
+        messages = notification.get_formatted_messages(("digest_subject.txt", "digest_body.txt"), "digest", context)
+        subject = "".join(messages["digest_subject.txt"].splitlines())
+        body = pynliner.fromString(messages["digest_body.txt"])
+        # the backend signals email_sent for the first notice type, the
+        # others are signalled once the digest is delivered
+        notice_types = sorted(set(item.notice_type for item in items), key=lambda notice_type: notice_type.pk)
+        digests.append((notification.Delivery(user, notice_types[0], to, subject, body, (), None), items,
+                        notice_types[1:]))
+        if len(digests) >= backend.batch_size:
+            delivered_digests, delivered_items = deliver_digests(backend, digests, frequency)
+            users += delivered_digests
+            sent += delivered_items
+            digests = []
+    delivered_digests, delivered_items = deliver_digests(backend, digests, frequency)
+    users += delivered_digests
+    sent += delivered_items
+
+    # reset environment to original language
+    activate(current_language)
+    logging.info("%s digests, %s notices" % (users, sent))
+    logging.info("done in %.2f seconds" % (time.time() - start_time))
+
+
+def deliver_digests(backend, digests, frequency):
+    """
+    Delivers a batch of ``(delivery, items, other notice types)`` digests and
+    deletes the items of the delivered ones. Returns the number of digests
+    and of items delivered.
+    """
+    if not digests:
+        return 0, 0
+    delivered = []
+    errors = backend.deliver([delivery for delivery, items, notice_types in digests])
+    for (delivery, items, notice_types), error in zip(digests, errors):
+        if error is not None:
+            # leave the items for the next run
+            notification.notifications_logger.error(
+                "ERROR:DIGEST:%s: data=(frequency=%s, items=%s, error=%r)" % (
+                    delivery.user, frequency, len(items), error))
+            continue
+        try:
+            for notice_type in notice_types:
+                notification.email_sent.send(sender=notification.Notice, user=delivery.user,
+                                             notice_type=notice_type, obj=None)
+        except Exception:
+            notification.notifications_logger.exception(
+                "ERROR:DIGEST:%s: data=(frequency=%s, items=%s)" % (delivery.user, frequency, len(items)))
+        notification.notifications_logger.info(
+            "SUCCESS:DIGEST:%s: data=(frequency=%s, items=%s)" % (delivery.user, frequency, len(items)))
+        delivered.extend(items)
+    DigestItem.objects.filter(pk__in=[item.pk for item in delivered]).delete()
+    return errors.count(None), len(delivered)
+
+
+def claim_outbox_batch(batch_size=None):
+    """
+    Returns up to ``batch_size`` due outbox messages and leases them to the
+    caller, so concurrent workers never get the same message.
+
+    Where the database can, the due rows are locked as they are read, and
+    skipped by the other workers if it supports SKIP LOCKED. Elsewhere, like
+    on SQLite, every row is leased with an update that only matches it while
+    it is still due, and only the rows whose update won are returned.
+    """
+    now = timezone.now()
+    lease = now + timedelta(seconds=OUTBOX_LEASE)
+    features = connection.features
+    with transaction.atomic():
+        due = OutboxMessage.objects.filter(status=OUTBOX_PENDING, next_attempt__lte=now)
+        candidates = due
+        if features.has_select_for_update_skip_locked:
+            candidates = due.select_for_update(skip_locked=True)
+        elif features.has_select_for_update:
+            candidates = due.select_for_update()
+        pks = list(candidates.order_by("next_attempt").values_list("pk", flat=True)[:batch_size or OUTBOX_BATCH_SIZE])
+        if features.has_select_for_update:
+            OutboxMessage.objects.filter(pk__in=pks).update(next_attempt=lease)
+        else:
+            pks = [pk for pk in pks if due.filter(pk=pk).update(next_attempt=lease)]
+    return list(OutboxMessage.objects.filter(pk__in=pks).select_related(
+        "recipient", "notice_type").prefetch_related("obj"))
+
+
+def renew_outbox_lease(messages):
+    """
+    Extends the lease on ``messages``, all claimed together, and returns
+    those the caller still holds. A message whose lease ran out and that
+    another worker claimed since is left out, so that it is not sent twice.
+    """
+    if not messages:
+        return []
+    lease = timezone.now() + timedelta(seconds=OUTBOX_LEASE)
+    pks = [message.pk for message in messages]
+    with transaction.atomic():
+        # the updated rows stay locked until the transaction ends, so reading
+        # back the new lease tells exactly which of them were still ours
+        OutboxMessage.objects.filter(
+            pk__in=pks, status=OUTBOX_PENDING, next_attempt=messages[0].next_attempt).update(next_attempt=lease)
+        held = set(OutboxMessage.objects.filter(pk__in=pks, next_attempt=lease).values_list("pk", flat=True))
+    messages = [message for message in messages if message.pk in held]
+    for message in messages:
+        message.next_attempt = lease
+    return messages
+
+
+def retry_delay(attempts):
+    return min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+
+
+def send_outbox(batch_size=None):
+    """
+    Delivers due OutboxMessages in batches until none are left, handing
+    each medium's backend all of its messages in a batch at once. Failed
+    messages are retried with exponential backoff and given up on after
+    OUTBOX_MAX_ATTEMPTS. Any number of workers can run this concurrently.
+
+    The lease on a medium's messages is renewed before they are handed to
+    its backend, so it only has to cover one backend's delivery.
+    """
+    delivered, failed = 0, 0
+    start_time = time.time()
+
+    while True:
+        messages = claim_outbox_batch(batch_size)
+        if not messages:
+            break
+        by_medium = {}
+        for message in messages:
+            by_medium.setdefault(message.medium, []).append(message)
+        for medium, medium_messages in by_medium.items():
+            medium_messages = renew_outbox_lease(medium_messages)
+            if not medium_messages:
+                continue
+            sent_pks = []
+            errors = notification.get_backend(medium).deliver([message.delivery() for message in medium_messages])
+            for message, e in zip(medium_messages, errors):
+                if e is None:
+                    sent_pks.append(message.pk)
+                    continue
+                message.attempts += 1
+                message.last_error = repr(e)
+                if message.attempts >= OUTBOX_MAX_ATTEMPTS:
+                    message.status = OUTBOX_FAILED
+                else:
+                    message.next_attempt = timezone.now() + timedelta(seconds=retry_delay(message.attempts))
+                message.save(update_fields=["attempts", "last_error", "status", "next_attempt"])
+                failed += 1
+            OutboxMessage.objects.filter(pk__in=sent_pks).update(status=OUTBOX_SENT, attempts=F("attempts") + 1)
+            delivered += len(sent_pks)
+
+    OutboxMessage.objects.filter(
+        status=OUTBOX_SENT, added__lt=timezone.now() - timedelta(days=OUTBOX_KEEP_DAYS)).delete()
+
+    logging.info("%s delivered, %s failed" % (delivered, failed))
+    logging.info("done in %.2f seconds" % (time.time() - start_time))
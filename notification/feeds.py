@@ -39,7 +39,7 @@ class BaseNoticeFeed(Feed):
         return [{"href" : self.item_id(notification)}]
 
     def item_authors(self, notification):
-        return [{"name" : notification.user.username}]
+        return [{"name" : notification.recipient.username}]
 
 
 class NoticeUserFeed(BaseNoticeFeed):
@@ -57,13 +57,13 @@ class NoticeUserFeed(BaseNoticeFeed):
         return _('Notices Feed')
 
     def feed_updated(self, user):
-        qs = Notice.objects.filter(user=user)
+        latest = Notice.objects.filter(recipient=user).order_by('-added').values_list('added', flat=True)[:1]
         # We return an arbitrary date if there are no results, because there
         # must be a feed_updated field as per the Atom specifications, however
         # there is no real data to go by, and an arbitrary date can be static.
-        if qs.count() == 0:
+        if not latest:
             return datetime(year=2008, month=7, day=1).replace(tzinfo=timezone.utc)
-        return qs.latest('added').added
+        return latest[0]
 
     def feed_links(self, user):
         complete_url = "%s://%s%s" % (
@@ -74,4 +74,4 @@ class NoticeUserFeed(BaseNoticeFeed):
         return ({'href': complete_url},)
 
     def items(self, user):
-        return Notice.objects.notices_for(user).order_by("-added")[:ITEMS_PER_FEED]
+        return Notice.objects.notices_for(user).select_related("recipient").order_by("-added")[:ITEMS_PER_FEED]
@@ -53,10 +53,16 @@ Exceptions:
 import sys
 import socket
 import os
+import signal
 import threading
 import time
 import errno
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Work with PEP8 and non-PEP8 versions of threading module.
 try:
     threading.current_thread
@@ -70,7 +76,7 @@ except AttributeError:
 
 __all__ = ['Error', 'LockError', 'LockTimeout', 'AlreadyLocked',
            'LockFailed', 'UnlockError', 'NotLocked', 'NotMyLock',
-           'LinkFileLock', 'MkdirFileLock', 'SQLiteFileLock']
+           'LinkFileLock', 'MkdirFileLock', 'SQLiteFileLock', 'FlockFileLock']
 
 class Error(Exception):
     """
@@ -218,6 +224,13 @@ class LockBase:
         """
         raise NotImplemented("implement in subclass")
 
+    def holder(self):
+        """
+        Return a (pid, hostname) tuple describing who holds the lock, or None
+        if that is not known.
+        """
+        return None
+
     def __enter__(self):
         """
         Context manager support.
@@ -365,17 +378,20 @@ class MkdirFileLock(LockBase):
 class SQLiteFileLock(LockBase):
     "Demonstration of using same SQL-based locking."
 
-    import tempfile
-    _fd, testdb = tempfile.mkstemp()
-    os.close(_fd)
-    os.unlink(testdb)
-    del _fd, tempfile
+    # created by the first instance, not at import time
+    testdb = None
 
     def __init__(self, path, threaded=True):
         LockBase.__init__(self, path, threaded)
         self.lock_file = str(self.lock_file)
         self.unique_name = str(self.unique_name)
 
+        if SQLiteFileLock.testdb is None:
+            import tempfile
+            fd, SQLiteFileLock.testdb = tempfile.mkstemp()
+            os.close(fd)
+            os.unlink(SQLiteFileLock.testdb)
+
         import sqlite3
         self.connection = sqlite3.connect(SQLiteFileLock.testdb)
         
@@ -494,7 +510,130 @@ class SQLiteFileLock(LockBase):
                        (self.lock_file,))
         self.connection.commit()
 
-if hasattr(os, "link"):
+class FlockFileLock(LockBase):
+    """Lock a file with flock(2).
+
+    Waiting for the lock blocks in the kernel instead of polling, and the
+    kernel drops the lock when the holding process exits, so a crashed
+    worker never leaves a stale lock behind. The holder's pid and hostname
+    are written into the lock file for diagnostics (see holder()).
+
+    Waiting with a positive timeout uses SIGALRM, which is only possible in
+    the main thread and only while the caller has no alarm of its own set;
+    otherwise it polls with an increasing interval.
+    """
+
+    def __init__(self, path, threaded=True):
+        LockBase.__init__(self, path, threaded)
+        self.fd = None
+
+    def acquire(self, timeout=None):
+        if self.fd is not None:
+            # Already locked by me.
+            return
+        try:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            raise LockFailed
+        try:
+            if timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            elif timeout <= 0:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    err = sys.exc_info()[1]
+                    if err.errno in (errno.EAGAIN, errno.EACCES):
+                        raise AlreadyLocked
+                    raise LockFailed
+            else:
+                self._wait(fd, timeout)
+            os.ftruncate(fd, 0)
+            os.write(fd, ("%s %s\n" % (os.getpid(), self.hostname)).encode("utf-8"))
+        except:
+            # closing the descriptor also drops the lock if the alarm went
+            # off just after it was granted
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def _wait(self, fd, timeout):
+        if (isinstance(threading.current_thread(), threading._MainThread) and hasattr(signal, "setitimer")
+                and not signal.getitimer(signal.ITIMER_REAL)[0]):
+            # with no alarm pending, disarming ours afterwards restores the
+            # caller's timer as it was
+            def on_alarm(signum, frame):
+                raise LockTimeout
+            previous = signal.signal(signal.SIGALRM, on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+            return
+        end_time = time.time() + timeout
+        wait = 0.01
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise LockFailed
+            if time.time() > end_time:
+                raise LockTimeout
+            time.sleep(wait)
+            wait = min(wait * 2, 1.0)
+
+    def release(self):
+        if self.fd is None:
+            if self.is_locked():
+                raise NotMyLock
+            raise NotLocked
+        fd, self.fd = self.fd, None
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def is_locked(self):
+        if self.fd is not None:
+            return True
+        try:
+            fd = os.open(self.lock_file, os.O_RDWR)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return True
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return False
+        finally:
+            os.close(fd)
+
+    def i_am_locking(self):
+        return self.fd is not None
+
+    def break_lock(self):
+        # the kernel releases the lock of a dead holder by itself, a lock held
+        # by a live process cannot be broken
+        if os.path.exists(self.lock_file) and not self.is_locked():
+            os.unlink(self.lock_file)
+
+    def holder(self):
+        try:
+            with open(self.lock_file) as f:
+                pid, hostname = f.read().split()
+            return int(pid), hostname
+        except (IOError, OSError, ValueError):
+            return None
+
+if fcntl is not None:
+    FileLock = FlockFileLock
+elif hasattr(os, "link"):
     FileLock = LinkFileLock
 else:
     FileLock = MkdirFileLock
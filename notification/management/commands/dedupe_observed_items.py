@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from notification.models import ObservedItem
+
+
+class Command(BaseCommand):
+    help = "Delete all but the oldest of the observed items with the same object, signal and user."
+
+    def handle(self, *args, **options):
+        deleted = ObservedItem.objects.delete_duplicates()
+        self.stdout.write("%s duplicate observed items deleted" % deleted)
@@ -0,0 +1,19 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from notification.engine import send_digests
+from notification.models import DIGEST_FREQUENCIES
+
+
+class Command(BaseCommand):
+    help = "Emit one summary email per user for pending digest notices."
+
+    def add_arguments(self, parser):
+        parser.add_argument("frequency", choices=[frequency for frequency, display in DIGEST_FREQUENCIES],
+                            help="which digests to send; run this from cron at the matching interval")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        send_digests(options["frequency"])
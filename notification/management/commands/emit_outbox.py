@@ -0,0 +1,18 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from notification.engine import send_outbox
+
+
+class Command(BaseCommand):
+    help = "Deliver pending outbox messages, retrying failed ones with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            help="number of messages to claim at a time")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        logging.info("-" * 72)
+        send_outbox(options["batch_size"])
@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from notification.models import NoticeQueueBatch
+
+
+def format_age(seconds):
+    if seconds is None:
+        return "-"
+    return "%dh%02dm%02ds" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class Command(BaseCommand):
+    help = "Report the number, size and age of queued notice batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", dest="json",
+                            help="print the statistics as JSON, for monitoring scripts")
+
+    def handle(self, *args, **options):
+        stats = NoticeQueueBatch.objects.stats()
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+            return
+        self.stdout.write("batches:    %d (%d due)" % (stats["batches"], stats["due"]))
+        self.stdout.write("recipients: %d" % stats["recipients"])
+        self.stdout.write("oldest:     %s" % format_age(stats["oldest_age"]))
+        if stats["labels"]:
+            self.stdout.write("")
+            self.stdout.write("%-40s %8s %10s %10s" % ("label", "batches", "recipients", "oldest"))
+            for row in stats["labels"]:
+                self.stdout.write("%-40s %8d %10d %10s" % (
+                    row["label"], row["batches"], row["recipients"], format_age(row["oldest_age"])))
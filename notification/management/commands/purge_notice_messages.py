@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from notification.models import NoticeMessage
+
+
+class Command(BaseCommand):
+    help = "Delete the stored notice messages no notice points to any more."
+
+    def handle(self, *args, **options):
+        deleted = NoticeMessage.objects.delete_unused()
+        self.stdout.write("%s unused notice messages deleted" % deleted)
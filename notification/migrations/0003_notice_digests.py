@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notification', '0002_auto_20171116_0359'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'frequency',
+                    models.CharField(
+                        max_length=10,
+                        verbose_name='frequency',
+                        choices=[('hourly', 'Hourly'), ('daily', 'Daily'), ('weekly', 'Weekly')]
+                    )
+                ),
+                ('subject', models.TextField(verbose_name='subject')),
+                ('message', models.TextField(verbose_name='message')),
+                ('added', models.DateTimeField(default=django.utils.timezone.now, verbose_name='added')),
+                (
+                    'notice_type',
+                    models.ForeignKey(
+                        verbose_name='notice type', to='notification.NoticeType', on_delete=models.CASCADE
+                    )
+                ),
+                ('user', models.ForeignKey(verbose_name='user', to=settings.AUTH_USER_MODEL, on_delete=models.CASCADE)),
+            ],
+            options={
+                'ordering': ['added'],
+                'verbose_name': 'digest item',
+                'verbose_name_plural': 'digest items',
+            },
+        ),
+        migrations.CreateModel(
+            name='NoticeDigestSetting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'frequency',
+                    models.CharField(
+                        max_length=10,
+                        verbose_name='frequency',
+                        choices=[('hourly', 'Hourly'), ('daily', 'Daily'), ('weekly', 'Weekly')]
+                    )
+                ),
+                (
+                    'notice_type',
+                    models.ForeignKey(
+                        verbose_name='notice type', to='notification.NoticeType', on_delete=models.CASCADE
+                    )
+                ),
+                ('user', models.ForeignKey(verbose_name='user', to=settings.AUTH_USER_MODEL, on_delete=models.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'notice digest setting',
+                'verbose_name_plural': 'notice digest settings',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='noticedigestsetting',
+            unique_together=set([('user', 'notice_type')]),
+        ),
+        migrations.AddIndex(
+            model_name='digestitem',
+            index=models.Index(fields=['frequency', 'user', 'added'], name='notification_digest_pending'),
+        ),
+    ]
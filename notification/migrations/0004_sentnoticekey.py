@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0003_notice_digests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentNoticeKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True, verbose_name='key')),
+                ('added', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='added')),
+            ],
+            options={
+                'verbose_name': 'sent notice key',
+                'verbose_name_plural': 'sent notice keys',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0004_sentnoticekey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='priority',
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, 'high'), (2, 'medium'), (3, 'low')], default=2, verbose_name='priority'
+            ),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='not_before',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='not before'),
+        ),
+        migrations.AddIndex(
+            model_name='noticequeuebatch',
+            index=models.Index(fields=['priority', 'not_before'], name='notification_batch_due'),
+        ),
+    ]
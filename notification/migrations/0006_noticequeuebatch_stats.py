@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import pickle
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def denormalize_batches(apps, schema_editor):
+    NoticeQueueBatch = apps.get_model('notification', 'NoticeQueueBatch')
+    for batch in NoticeQueueBatch.objects.iterator():
+        notices = pickle.loads(base64.b64decode(batch.pickled_data))
+        if notices:
+            batch.label = notices[0][1]
+        batch.recipient_count = len(notices)
+        batch.save(update_fields=['label', 'recipient_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0005_noticequeuebatch_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='label',
+            field=models.CharField(blank=True, max_length=40, verbose_name='label'),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='recipient_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='recipient count'),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='added',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='added'),
+        ),
+        migrations.AddIndex(
+            model_name='noticequeuebatch',
+            index=models.Index(fields=['label', 'added'], name='notification_batch_label'),
+        ),
+        migrations.RunPython(denormalize_batches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notification', '0006_noticequeuebatch_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'medium',
+                    models.CharField(
+                        max_length=1,
+                        verbose_name='medium',
+                        choices=[('1', 'Email'), ('2', 'Display'), ('3', 'SMS')]
+                    )
+                ),
+                ('to', models.CharField(max_length=254, verbose_name='to')),
+                ('subject', models.TextField(blank=True, verbose_name='subject')),
+                ('body', models.TextField(verbose_name='body')),
+                ('obj_id', models.PositiveIntegerField(blank=True, null=True)),
+                (
+                    'status',
+                    models.CharField(
+                        max_length=10,
+                        default='pending',
+                        verbose_name='status',
+                        choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed')]
+                    )
+                ),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='next attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('added', models.DateTimeField(default=django.utils.timezone.now, verbose_name='added')),
+                (
+                    'notice_type',
+                    models.ForeignKey(
+                        verbose_name='notice type', to='notification.NoticeType', on_delete=models.CASCADE
+                    )
+                ),
+                (
+                    'obj_content_type',
+                    models.ForeignKey(blank=True, null=True, to='contenttypes.ContentType', on_delete=models.CASCADE)
+                ),
+                (
+                    'recipient',
+                    models.ForeignKey(
+                        related_name='outbox_messages',
+                        verbose_name='recipient',
+                        to=settings.AUTH_USER_MODEL,
+                        on_delete=models.CASCADE
+                    )
+                ),
+            ],
+            options={
+                'verbose_name': 'outbox message',
+                'verbose_name_plural': 'outbox messages',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['status', 'next_attempt'], name='notification_outbox_due'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """
+    Adds the index with CREATE INDEX CONCURRENTLY on PostgreSQL, so that
+    notices can still be saved while it is built, and like AddIndex
+    elsewhere. It cannot run in a transaction, the migration must not be
+    atomic.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddIndexConcurrently, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            sql = str(self.index.create_sql(model, schema_editor))
+            schema_editor.execute(sql.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddIndexConcurrently, self).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % schema_editor.quote_name(self.index.name))
+
+    def describe(self):
+        return 'Concurrently create index %s on field(s) %s of model %s' % (
+            self.index.name, ', '.join(self.index.fields), self.model_name)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY refuses to run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('notification', '0007_outboxmessage'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='notice',
+            index=models.Index(fields=['notice_type', 'added'], name='notification_notice_type'),
+        ),
+        AddIndexConcurrently(
+            model_name='notice',
+            index=models.Index(fields=['unseen', 'added'], name='notification_notice_unseen'),
+        ),
+    ]
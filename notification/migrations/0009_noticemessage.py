@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0008_notice_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoticeMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True, verbose_name='digest')),
+                ('data', models.TextField(verbose_name='data')),
+                ('compressed', models.BooleanField(default=False, verbose_name='compressed')),
+                ('added', models.DateTimeField(default=django.utils.timezone.now, verbose_name='added')),
+            ],
+            options={
+                'verbose_name': 'notice message',
+                'verbose_name_plural': 'notice messages',
+            },
+        ),
+        # blank only matters to forms, the table is not touched
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='notice',
+                    name='message',
+                    field=models.TextField(blank=True, verbose_name='message'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notice',
+            name='body',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='notices', to='notification.NoticeMessage', verbose_name='body'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicates(apps, schema_editor):
+    ObservedItem = apps.get_model('notification', 'ObservedItem')
+    fields = ('content_type', 'object_id', 'signal', 'user')
+    duplicates = ObservedItem.objects.order_by().values(*fields).annotate(
+        keep=Min('pk'), count=Count('pk')).filter(count__gt=1)
+    for row in list(duplicates):
+        ObservedItem.objects.filter(**dict((field, row[field]) for field in fields)).exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('notification', '0009_noticemessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='observeditem',
+            name='signal',
+            field=models.CharField(max_length=100, verbose_name='signal'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='observeditem',
+            unique_together=set([('content_type', 'object_id', 'signal', 'user')]),
+        ),
+    ]
@@ -1,8 +1,19 @@
 from __future__ import print_function
 
+import atexit
+import base64
+import hashlib
 import logging
+import mimetypes
+import mmap
+import os
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from email.mime.base import MIMEBase
 
-import pynliner
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
@@ -11,20 +22,23 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 
 from django.core import mail
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
-from django.core.mail import EmailMultiAlternatives
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Case, Count, IntegerField, Min, Q, Sum, When
 from django.db.models.query import QuerySet
 from django.template import engines
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from django.utils.translation import activate, get_language
 from django.utils.translation import ugettext as _
-from postmark import PMMail
-from twilio.rest import TwilioRestClient
 
 
+from .audience import Audience, ObserverAudience, UserAudience
+from .backends.base import Delivery
+from .render import init_process as _init_render_process, render_shard as _render_shard
 from .signals import email_sent, sms_sent
 
 try:
@@ -32,13 +46,75 @@ try:
 except ImportError:
     import pickle
 
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    class BrokenProcessPool(RuntimeError):
+        pass
+
 
 notifications_logger = logging.getLogger("pivot.notifications")
 
 QUEUE_ALL = getattr(settings, "NOTIFICATION_QUEUE_ALL", False)
-TWILIO_ACCOUNT_SID = getattr(settings, "TWILIO_ACCOUNT_SID", False)
-TWILIO_ACCOUNT_TOKEN = getattr(settings, "TWILIO_ACCOUNT_TOKEN", False)
-TWILIO_CALLER_ID = getattr(settings, "TWILIO_CALLER_ID", False)
+# how many recipients send_now resolves settings for and saves notices for at once
+SEND_CHUNK_SIZE = getattr(settings, "NOTIFICATION_SEND_CHUNK_SIZE", 500)
+# seconds within which a repeated notice to the same user is dropped, per
+# notice type label; 0 turns duplicate suppression off
+DEDUPE_WINDOW = getattr(settings, "NOTIFICATION_DEDUPE_WINDOW", 0)
+DEDUPE_WINDOWS = getattr(settings, "NOTIFICATION_DEDUPE_WINDOWS", {})
+# store rendered emails and text messages in OutboxMessage for
+# engine.send_outbox to deliver instead of delivering them from send_now
+USE_OUTBOX = getattr(settings, "NOTIFICATION_USE_OUTBOX", False)
+# how many recipients go into one NoticeQueueBatch, and how many batches
+# queue() writes with one INSERT
+QUEUE_BATCH_SIZE = getattr(settings, "NOTIFICATION_QUEUE_BATCH_SIZE", 1000)
+QUEUE_BULK_SIZE = getattr(settings, "NOTIFICATION_QUEUE_BULK_SIZE", 10)
+# store the rendered message of a notice once per distinct text in
+# NoticeMessage instead of once per recipient, zlib compressed if
+# MESSAGE_COMPRESS is set
+MESSAGE_STORE = getattr(settings, "NOTIFICATION_MESSAGE_STORE", False)
+MESSAGE_COMPRESS = getattr(settings, "NOTIFICATION_MESSAGE_COMPRESS", False)
+# deliver emails and text messages from this many threads while send_now
+# goes on rendering and saving the next recipients, with at most
+# DELIVERY_BACKLOG batches of them waiting; 0 delivers them in the calling
+# thread
+DELIVERY_THREADS = getattr(settings, "NOTIFICATION_DELIVERY_THREADS", 0)
+DELIVERY_BACKLOG = getattr(settings, "NOTIFICATION_DELIVERY_BACKLOG", 20)
+# render the notices of chunks with at least RENDER_MIN_RECIPIENTS
+# recipients in this many processes; 0 renders them in the calling process
+RENDER_PROCESSES = getattr(settings, "NOTIFICATION_RENDER_PROCESSES", 0)
+RENDER_MIN_RECIPIENTS = getattr(settings, "NOTIFICATION_RENDER_MIN_RECIPIENTS", 100)
+# the media notices go out through: their id, label, how spam-sensitive
+# they are (on by default for notice types whose default is at least this)
+# and the dotted path of the backend delivering them, which is imported the
+# first time the medium is used. Ids are a single character.
+# NOTIFICATION_EMAIL_BACKEND replaces just the email backend.
+MEDIA = getattr(settings, "NOTIFICATION_MEDIA", (
+    ("1", "Email", 2,
+     getattr(settings, "NOTIFICATION_EMAIL_BACKEND", None) or "notification.backends.email.EmailBackend"),
+    ("2", "Display", 3, "notification.backends.base.OnSiteBackend"),
+    ("3", "SMS", 3, "notification.backends.sms.TwilioBackend"),
+))
+# attachment files at least this large are memory-mapped while they are
+# encoded instead of being read into memory first
+ATTACHMENT_MMAP_SIZE = getattr(settings, "NOTIFICATION_ATTACHMENT_MMAP_SIZE", 1024 * 1024)
+# have handle_observations queue observer notices for emit_notices instead of
+# sending them from the request that saved the observed object
+QUEUE_OBSERVATIONS = getattr(settings, "NOTIFICATION_QUEUE_OBSERVATIONS", False)
+# the cache holding the inbox versions, and for how long
+CACHE = getattr(settings, "NOTIFICATION_CACHE", "default")
+INBOX_VERSION_TIMEOUT = getattr(settings, "NOTIFICATION_INBOX_VERSION_TIMEOUT", 7 * 24 * 60 * 60)
+# how long data cached for an inbox version is kept; a new version makes it
+# unreachable anyway, this only bounds how long it takes up space
+INBOX_CACHE_TIMEOUT = getattr(settings, "NOTIFICATION_INBOX_CACHE_TIMEOUT", 60 * 60)
+# how long the set of observed models is cached; it is rebuilt early when
+# observed items are added or deleted
+OBSERVED_TYPES_TIMEOUT = getattr(settings, "NOTIFICATION_OBSERVED_TYPES_TIMEOUT", 5 * 60)
 
 if 'guardian' in settings.INSTALLED_APPS:
     enable_object_notifications = True
@@ -74,12 +150,7 @@ class NoticeType(models.Model):
         verbose_name_plural = _("notice types")
 
 
-# if this gets updated, the create() method below needs to be as well...
-NOTICE_MEDIA = (
-    ("1", _("Email")),
-    ("2", _("Display")),
-    ("3", _("SMS")),
-)
+NOTICE_MEDIA = tuple((medium, _(label)) for medium, label, sensitivity, backend in MEDIA)
 
 
 def notice_medium_as_text(medium):
@@ -87,11 +158,19 @@ def notice_medium_as_text(medium):
 
 
 # how spam-sensitive is the medium
-NOTICE_MEDIA_DEFAULTS = {
-    "1": 2,  # email
-    "2": 3,
-    "3": 3,
-}
+NOTICE_MEDIA_DEFAULTS = dict((medium, sensitivity) for medium, label, sensitivity, backend in MEDIA)
+
+_backends = {}
+
+
+def get_backend(medium):
+    """
+    Returns the backend delivering ``medium``, importing it on first use.
+    """
+    if medium not in _backends:
+        path = dict((medium, backend) for medium, label, sensitivity, backend in MEDIA)[medium]
+        _backends[medium] = import_string(path)(medium)
+    return _backends[medium]
 
 
 class NoticeSetting(models.Model):
@@ -126,6 +205,47 @@ def get_notification_setting(user, notice_type, medium):
         return setting
 
 
+def get_notification_settings(users, notice_types, media):
+    """
+    Returns a dictionary mapping ``(user_id, notice_type_id, medium)`` to the
+    NoticeSetting for every combination of the given users, notice types and
+    media.
+
+    Missing settings are created with their defaults, so this costs a constant
+    number of queries however many combinations are asked for.
+    """
+    user_ids = set(user.pk for user in users)
+    notice_types = dict((notice_type.pk, notice_type) for notice_type in notice_types)
+
+    def fetch():
+        return dict(
+            ((setting.user_id, setting.notice_type_id, setting.medium), setting)
+            for setting in NoticeSetting.objects.filter(
+                user__in=user_ids, notice_type__in=list(notice_types), medium__in=media)
+        )
+
+    notice_settings = fetch()
+    missing = [
+        NoticeSetting(user_id=user_id, notice_type=notice_type, medium=medium,
+                      send=(NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default))
+        for user_id in user_ids
+        for notice_type in notice_types.values()
+        for medium in media
+        if (user_id, notice_type.pk, medium) not in notice_settings
+    ]
+    if missing:
+        try:
+            with transaction.atomic():
+                NoticeSetting.objects.bulk_create(missing)
+        except IntegrityError:
+            # a concurrent request created some of them first, fetching again
+            # below picks those up
+            pass
+        # fetch again so that the new settings have primary keys
+        notice_settings = fetch()
+    return notice_settings
+
+
 def get_all_notification_settings(user):
     return NoticeSetting.objects.filter(user=user)
 
@@ -137,14 +257,75 @@ def create_notification_setting(user, notice_type, medium):
     return setting
 
 
-def should_send(user, notice_type, medium, obj_instance=None):
+def should_send(user, notice_type, medium, obj_instance=None, setting=None):
+    """
+    ``setting`` may be passed in when the user's NoticeSetting for this notice
+    type and medium has already been fetched (see get_notification_settings).
+    """
     if enable_object_notifications and obj_instance:
         has_custom_settings = custom_permission_check('custom_notification_settings', obj_instance, user)
         if has_custom_settings:
             medium_text = notice_medium_as_text(medium)
             perm_string = "%s-%s" % (medium_text, notice_type.label)
             return custom_permission_check(perm_string, obj_instance, user)
-    return get_notification_setting(user, notice_type, medium).send
+    if setting is None:
+        setting = get_notification_setting(user, notice_type, medium)
+    return setting.send
+
+
+def _inbox_version_key(user_id):
+    return "notification:inbox:%s" % user_id
+
+
+def get_inbox_version(user, stored_only=False):
+    """
+    Returns an opaque version of the user's inbox, which changes whenever the
+    user receives a notice or one of their notices is changed or deleted.
+    Reading it costs one cache lookup, so it is cheap to poll.
+
+    When the cache does not keep the version, e.g. a DummyCache or a key
+    evicted right away, a new version is returned on every call, so that
+    nothing is taken for unchanged. With ``stored_only`` None is returned
+    instead.
+    """
+    cache = caches[CACHE]
+    key = _inbox_version_key(getattr(user, "pk", user))
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key, version, INBOX_VERSION_TIMEOUT)
+        # ours, or the one a concurrent read stored first
+        stored = cache.get(key)
+        if stored is not None:
+            version = stored
+        elif stored_only:
+            return None
+    return version
+
+
+def inbox_changed(user_ids):
+    """
+    Gives the inboxes of the given users a new version. The versions are
+    dropped and recreated on the next read, so any number of inboxes is
+    invalidated with a single cache call.
+    """
+    caches[CACHE].delete_many([_inbox_version_key(user_id) for user_id in set(user_ids)])
+
+
+def cached_for_inbox(user, name, build):
+    """
+    Returns ``build()``, cached as ``name`` for the current version of the
+    user's inbox. It is rebuilt on the first call after the inbox changes.
+    """
+    cache = caches[CACHE]
+    # read the version first, so that a change made while building gives the
+    # inbox a version the result is not stored under
+    key = "notification:%s:%s:%s" % (name, user.pk, get_inbox_version(user))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, INBOX_CACHE_TIMEOUT)
+    return value
 
 
 class NoticeManager(models.Manager):
@@ -171,7 +352,7 @@ class NoticeManager(models.Manager):
             qs = qs.filter(unseen=unseen)
         if on_site is not None:
             qs = qs.filter(on_site=on_site)
-        return qs
+        return qs.select_related("body")
 
     def unseen_count_for(self, recipient, **kwargs):
         """
@@ -180,6 +361,22 @@ class NoticeManager(models.Manager):
         """
         return self.notices_for(recipient, unseen=True, **kwargs).count()
 
+    def counts_for(self, recipient, **kwargs):
+        """
+        returns a dictionary with the number of ``unseen`` and ``total``
+        notices of the given user per notice type label, counted with a
+        single query and cached until the user's inbox changes. Takes the
+        same filters as notices_for.
+        """
+        def count():
+            rows = self.notices_for(recipient, **kwargs).order_by().values("notice_type__label").annotate(
+                total=Count("pk"),
+                unseen=Sum(Case(When(unseen=True, then=1), default=0, output_field=IntegerField())))
+            return dict((row["notice_type__label"], {"unseen": row["unseen"], "total": row["total"]})
+                        for row in rows)
+        name = "counts:%s" % ",".join("%s=%s" % item for item in sorted(kwargs.items()))
+        return cached_for_inbox(recipient, name, count)
+
     def received(self, recipient, **kwargs):
         """
         returns notices the given recipient has recieved.
@@ -195,12 +392,142 @@ class NoticeManager(models.Manager):
         return self.notices_for(sender, **kwargs)
 
 
+class NoticeMessageManager(models.Manager):
+
+    def delete_unused(self, batch_size=1000):
+        """
+        Deletes the messages no notice points to any more, ``batch_size`` at
+        a time, and returns how many were deleted. A send reusing one of them
+        meanwhile fails with an IntegrityError and can be retried.
+        """
+        deleted = 0
+        while True:
+            pks = list(self.filter(notices__isnull=True).values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += self.filter(pk__in=pks, notices__isnull=True).delete()[0]
+
+
+class NoticeMessage(models.Model):
+    """
+    The rendered message of one or more notices, stored once per distinct
+    text and looked up by its digest.
+    """
+    digest = models.CharField(_('digest'), max_length=40, unique=True)
+    data = models.TextField(_('data'))
+    compressed = models.BooleanField(_('compressed'), default=False)
+    added = models.DateTimeField(_('added'), default=timezone.now)
+
+    objects = NoticeMessageManager()
+
+    class Meta:
+        verbose_name = _("notice message")
+        verbose_name_plural = _("notice messages")
+
+    @staticmethod
+    def digest_for(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def for_text(cls, text):
+        message = cls(digest=cls.digest_for(text), data=text)
+        if MESSAGE_COMPRESS:
+            data = base64.b64encode(zlib.compress(text.encode("utf-8"))).decode("ascii")
+            # short messages grow when compressed
+            if len(data) < len(text):
+                message.data, message.compressed = data, True
+        return message
+
+    @staticmethod
+    def decode(data, compressed):
+        if compressed:
+            return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+        return data
+
+    @property
+    def text(self):
+        return self.decode(self.data, self.compressed)
+
+
+def get_notice_messages(texts):
+    """
+    Returns a dictionary of NoticeMessages by text for the given texts,
+    creating the ones that are not stored yet.
+    """
+    digests = dict((NoticeMessage.digest_for(text), text) for text in texts)
+
+    def fetch():
+        return dict((message.digest, message) for message in NoticeMessage.objects.filter(digest__in=list(digests)))
+
+    messages = fetch()
+    missing = [NoticeMessage.for_text(text) for digest, text in digests.items() if digest not in messages]
+    if missing:
+        try:
+            with transaction.atomic():
+                NoticeMessage.objects.bulk_create(missing)
+        except IntegrityError:
+            # a concurrent send stored some of them first
+            for message in missing:
+                try:
+                    with transaction.atomic():
+                        message.save()
+                except IntegrityError:
+                    pass
+        messages = fetch()
+    return dict((digests[digest], message) for digest, message in messages.items())
+
+
+class NoticeTextDescriptor(object):
+    """
+    Reads a notice's text from its NoticeMessage when the text is stored
+    there instead of in its own column, see NoticeTextField.
+    """
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if self.field_name not in instance.__dict__:
+            # deferred
+            instance.refresh_from_db(fields=[self.field_name])
+        text = instance.__dict__[self.field_name]
+        if not text and instance.body_id is not None:
+            return instance.body.text
+        return text
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field_name] = value
+
+
+class NoticeTextField(models.TextField):
+    """
+    The ``message`` column of a notice. With NOTIFICATION_MESSAGE_STORE it is
+    left empty and the text is kept in the notice's ``body`` instead, which
+    reading the attribute falls back to. Queries see the column as it is.
+    """
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(NoticeTextField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, NoticeTextDescriptor(self.attname))
+
+    def deconstruct(self):
+        # a plain TextField as far as migrations are concerned
+        name, path, args, kwargs = super(NoticeTextField, self).deconstruct()
+        return name, "django.db.models.TextField", args, kwargs
+
+
 class Notice(models.Model):
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recieved_notices',
                                   verbose_name=_('recipient'))
     sender = models.ForeignKey(User, on_delete=models.CASCADE, null=True, related_name='sent_notices',
                                verbose_name=_('sender'))
-    message = models.TextField(_('message'))
+    # the message is either stored here or, with NOTIFICATION_MESSAGE_STORE,
+    # in body; reading notice.message returns it in either case
+    message = NoticeTextField(_('message'), blank=True)
+    body = models.ForeignKey(NoticeMessage, on_delete=models.PROTECT, null=True, blank=True,
+                             related_name='notices', verbose_name=_('body'))
     notice_type = models.ForeignKey(NoticeType, on_delete=models.CASCADE, verbose_name=_('notice type'))
     added = models.DateTimeField(_('added'), default=timezone.now, db_index=True)
     unseen = models.BooleanField(_('unseen'), default=True)
@@ -212,6 +539,16 @@ class Notice(models.Model):
     def __str__(self):
         return self.message
 
+    def save(self, *args, **kwargs):
+        super(Notice, self).save(*args, **kwargs)
+        inbox_changed([self.recipient_id])
+
+    def delete(self, *args, **kwargs):
+        recipient_id = self.recipient_id
+        result = super(Notice, self).delete(*args, **kwargs)
+        inbox_changed([recipient_id])
+        return result
+
     def archive(self):
         self.archived = True
         self.save()
@@ -233,17 +570,318 @@ class Notice(models.Model):
         ordering = ["-added"]
         verbose_name = _("notice")
         verbose_name_plural = _("notices")
+        # for filtering the admin changelist while keeping its ordering
+        indexes = [
+            models.Index(fields=["notice_type", "added"], name="notification_notice_type"),
+            models.Index(fields=["unseen", "added"], name="notification_notice_unseen"),
+        ]
 
     def get_absolute_url(self):
         return reverse("notification_notice", args=[str(self.pk)])
 
 
+PRIORITY_HIGH = 1
+PRIORITY_MEDIUM = 2
+PRIORITY_LOW = 3
+
+PRIORITIES = (
+    (PRIORITY_HIGH, _("high")),
+    (PRIORITY_MEDIUM, _("medium")),
+    (PRIORITY_LOW, _("low")),
+)
+
+
+class NoticeQueueBatchManager(models.Manager):
+
+    def due(self):
+        """
+        returns batches whose ``not_before`` has passed, in the order they
+        should be sent: by priority, then oldest first.
+        """
+        return self.filter(not_before__lte=timezone.now()).order_by("priority", "not_before", "pk")
+
+    def stats(self):
+        """
+        returns a dictionary describing the queue backlog: the number of
+        ``batches``, how many of them are ``due``, the total number of
+        ``recipients``, the ``oldest_age`` of a batch in seconds and the same
+        figures per notice type in ``labels``.
+
+        Only aggregate queries are used, no batch is unpickled.
+        """
+        now = timezone.now()
+
+        def age(oldest):
+            return (now - oldest).total_seconds() if oldest is not None else None
+
+        totals = self.aggregate(batches=Count("pk"), recipients=Sum("recipient_count"), oldest=Min("added"))
+        labels = self.order_by("label").values("label").annotate(
+            batches=Count("pk"), recipients=Sum("recipient_count"), oldest=Min("added"))
+        return {
+            "batches": totals["batches"],
+            "due": self.filter(not_before__lte=now).count(),
+            "recipients": totals["recipients"] or 0,
+            "oldest_age": age(totals["oldest"]),
+            "labels": [{
+                "label": row["label"],
+                "batches": row["batches"],
+                "recipients": row["recipients"] or 0,
+                "oldest_age": age(row["oldest"]),
+            } for row in labels],
+        }
+
+
 class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
     """
     pickled_data = models.TextField()
+    priority = models.PositiveSmallIntegerField(_('priority'), choices=PRIORITIES, default=PRIORITY_MEDIUM)
+    not_before = models.DateTimeField(_('not before'), default=timezone.now)
+    # denormalized from pickled_data so the backlog can be aggregated
+    label = models.CharField(_('label'), max_length=40, blank=True)
+    recipient_count = models.PositiveIntegerField(_('recipient count'), default=0)
+    added = models.DateTimeField(_('added'), default=timezone.now, db_index=True)
+
+    objects = NoticeQueueBatchManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["priority", "not_before"], name="notification_batch_due"),
+            models.Index(fields=["label", "added"], name="notification_batch_label"),
+        ]
+
+    @staticmethod
+    def encode(data):
+        # protocol 2 can be read by both Python 2 and 3 workers
+        return base64.b64encode(pickle.dumps(data, 2)).decode("ascii")
+
+    def decode(self):
+        return pickle.loads(base64.b64decode(self.pickled_data))
+
+    def notices(self):
+        """
+        Yields a ``(user_id, label, extra_context, on_site, sender)`` tuple
+        for every queued notice. The audience of a deferred batch is expanded
+        to do so.
+        """
+        data = self.decode()
+        if isinstance(data, dict) and "audience" in data:
+            for user in data["audience"].iterator(QUEUE_BATCH_SIZE):
+                yield user.pk, data["label"], data["extra_context"], data["on_site"], data["sender"]
+        elif isinstance(data, dict):
+            for user_id in data["users"]:
+                yield user_id, data["label"], data["extra_context"], data["on_site"], data["sender"]
+        else:
+            # batches queued before recipients were stored as a list of pks
+            for notice in data:
+                yield notice
+
+
+class SentNoticeKey(models.Model):
+    """
+    Remembers that a notice with the given dedupe key was recently sent, so
+    that repeats within the notice type's dedupe window can be dropped.
+    """
+    key = models.CharField(_('key'), max_length=40, unique=True)
+    added = models.DateTimeField(_('added'), default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = _("sent notice key")
+        verbose_name_plural = _("sent notice keys")
+
+
+def _dedupe_value(value):
+    if isinstance(value, models.Model):
+        return "%s:%s" % (value._meta.label, value.pk)
+    if isinstance(value, QuerySet):
+        # its query rather than its rows, which repr() would fetch and which
+        # change over time
+        return "%s:%s" % (value.model._meta.label, value.query)
+    if isinstance(value, dict):
+        return sorted((key, _dedupe_value(item)) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(_dedupe_value(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [_dedupe_value(item) for item in value]
+    return value
+
+
+def unsent_dedupe_keys(user_ids, label, extra_context=None, dedupe_key=None):
+    """
+    Returns a dictionary mapping dedupe keys to user ids for the users in
+    ``user_ids`` that have not been sent a notice with the same label and
+    dedupe key within the notice type's dedupe window, or None if the notice
+    type has no window. Nothing is recorded, see record_dedupe_keys.
+    """
+    window = DEDUPE_WINDOWS.get(label, DEDUPE_WINDOW)
+    if not window:
+        return None
+    if dedupe_key is None:
+        dedupe_key = repr(_dedupe_value(extra_context or {}))
+    keys = dict(
+        (hashlib.sha1(("%s:%s:%s" % (user_id, label, dedupe_key)).encode("utf-8")).hexdigest(), user_id)
+        for user_id in user_ids
+    )
+    cutoff = timezone.now() - timedelta(seconds=window)
+    recent = SentNoticeKey.objects.filter(key__in=list(keys), added__gte=cutoff).values_list("key", flat=True)
+    for key in recent:
+        del keys[key]
+    if keys:
+        # expired keys of the same notices are recorded again
+        SentNoticeKey.objects.filter(key__in=list(keys), added__lt=cutoff).delete()
+    return keys
+
+
+def record_dedupe_keys(keys):
+    """
+    Records the dedupe keys returned by unsent_dedupe_keys as sent and
+    returns the set of user ids whose key was recorded. Keys a concurrent
+    send recorded first are left out. Call it in the transaction that saves
+    the notices, so that the keys are rolled back if the send fails.
+    """
+    try:
+        with transaction.atomic():
+            SentNoticeKey.objects.bulk_create([SentNoticeKey(key=key) for key in keys])
+        recorded = set(keys)
+    except IntegrityError:
+        # a concurrent send got some of them first, keep only the keys we
+        # manage to record ourselves
+        recorded = set()
+        for key in keys:
+            try:
+                with transaction.atomic():
+                    SentNoticeKey.objects.create(key=key)
+                recorded.add(key)
+            except IntegrityError:
+                pass
+    return set(keys[key] for key in recorded)
+
+
+def drop_duplicates(user_ids, label, extra_context=None, dedupe_key=None):
+    """
+    Returns the subset of ``user_ids`` that has not been sent a notice with
+    the same label and dedupe key within the notice type's dedupe window, and
+    records the returned ones as sent.
+
+    ``dedupe_key`` defaults to a digest of ``extra_context``, so identical
+    notices are dropped. Passing a fixed key (e.g. the object a notice is
+    about) throttles a user to one notice per key and window instead.
+    """
+    keys = unsent_dedupe_keys(user_ids, label, extra_context, dedupe_key)
+    if keys is None:
+        return set(user_ids)
+    return record_dedupe_keys(keys)
+
+
+def purge_sent_notice_keys():
+    """
+    Deletes dedupe keys older than the longest dedupe window.
+    """
+    window = max([DEDUPE_WINDOW] + list(DEDUPE_WINDOWS.values()))
+    SentNoticeKey.objects.filter(added__lt=timezone.now() - timedelta(seconds=window)).delete()
+
+
+OUTBOX_PENDING = "pending"
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"
+
+OUTBOX_STATUSES = (
+    (OUTBOX_PENDING, _("pending")),
+    (OUTBOX_SENT, _("sent")),
+    (OUTBOX_FAILED, _("failed")),
+)
+
+
+class OutboxMessage(models.Model):
+    """
+    A rendered message waiting to be delivered to one recipient through one
+    medium. Used instead of delivering from send_now when
+    NOTIFICATION_USE_OUTBOX is set, see engine.send_outbox.
+    """
+    medium = models.CharField(_('medium'), max_length=1, choices=NOTICE_MEDIA)
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='outbox_messages',
+                                  verbose_name=_('recipient'))
+    notice_type = models.ForeignKey(NoticeType, on_delete=models.CASCADE, verbose_name=_('notice type'))
+    # email address or phone number
+    to = models.CharField(_('to'), max_length=254)
+    subject = models.TextField(_('subject'), blank=True)
+    body = models.TextField(_('body'))
+
+    # the object the notice is about, passed on to the email_sent and sms_sent signals
+    obj_content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True)
+    obj_id = models.PositiveIntegerField(null=True, blank=True)
+    obj = GenericForeignKey('obj_content_type', 'obj_id')
+
+    status = models.CharField(_('status'), max_length=10, choices=OUTBOX_STATUSES, default=OUTBOX_PENDING)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), default=timezone.now)
+    last_error = models.TextField(_('last error'), blank=True)
+    added = models.DateTimeField(_('added'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _("outbox message")
+        verbose_name_plural = _("outbox messages")
+        indexes = [
+            models.Index(fields=["status", "next_attempt"], name="notification_outbox_due"),
+        ]
+
+    def delivery(self):
+        return Delivery(self.recipient, self.notice_type, self.to, self.subject, self.body, (), self.obj)
+
+    def deliver(self):
+        """
+        Sends the message. Errors are logged and re-raised.
+        """
+        error, = get_backend(self.medium).deliver([self.delivery()])
+        if error is not None:
+            raise error
+
+
+DIGEST_FREQUENCIES = (
+    ("hourly", _("Hourly")),
+    ("daily", _("Daily")),
+    ("weekly", _("Weekly")),
+)
+
+
+class NoticeDigestSetting(models.Model):
+    """
+    Indicates, for a given user, that emails for a given notice type are
+    collected and sent as one summary email per ``frequency`` instead of one
+    email per notice.
+    """
+
+    user = models.ForeignKey(User, verbose_name=_('user'), on_delete=models.CASCADE)
+    notice_type = models.ForeignKey(NoticeType, verbose_name=_('notice type'), on_delete=models.CASCADE)
+    frequency = models.CharField(_('frequency'), max_length=10, choices=DIGEST_FREQUENCIES)
+
+    class Meta:
+        verbose_name = _("notice digest setting")
+        verbose_name_plural = _("notice digest settings")
+        unique_together = ("user", "notice_type")
+
+
+class DigestItem(models.Model):
+    """
+    A rendered notice waiting to be included in the user's next digest.
+    """
+
+    user = models.ForeignKey(User, verbose_name=_('user'), on_delete=models.CASCADE)
+    notice_type = models.ForeignKey(NoticeType, verbose_name=_('notice type'), on_delete=models.CASCADE)
+    frequency = models.CharField(_('frequency'), max_length=10, choices=DIGEST_FREQUENCIES)
+    subject = models.TextField(_('subject'))
+    message = models.TextField(_('message'))
+    added = models.DateTimeField(_('added'), default=timezone.now)
+
+    class Meta:
+        ordering = ["added"]
+        verbose_name = _("digest item")
+        verbose_name_plural = _("digest items")
+        indexes = [
+            models.Index(fields=["frequency", "user", "added"], name="notification_digest_pending"),
+        ]
 
 
 def create_notice_type(label, display, description, default=2, verbosity=1):
@@ -317,8 +955,223 @@ def get_formatted_messages(formats, label, context):
     return format_templates
 
 
+# base64 with a line break every 76 characters, as MIME wants it
+_encode_base64 = getattr(base64, "encodebytes", None) or base64.encodestring
+
+
+def _encode_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < ATTACHMENT_MMAP_SIZE:
+            return _encode_base64(f.read())
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _encode_base64(data)
+        finally:
+            data.close()
+
+
+def prepare_attachment(attachment):
+    """
+    Returns ``attachment`` as a MIME part whose payload is base64 encoded
+    already. EmailMessage.attach adds such a part to a message as it is, so
+    one part can go out with any number of emails and is encoded only once.
+
+    ``attachment`` is a MIMEBase instance, which is returned unchanged, a
+    ``(filename, content, mimetype)`` tuple as taken by EmailMessage.attach,
+    or the path of a file. Files of ATTACHMENT_MMAP_SIZE or more are
+    memory-mapped while they are encoded.
+    """
+    if isinstance(attachment, MIMEBase):
+        return attachment
+    charset = None
+    if isinstance(attachment, tuple):
+        filename, content, mimetype = (attachment + (None,))[:3]
+        if not isinstance(content, bytes):
+            content, charset = content.encode("utf-8"), "utf-8"
+        payload = _encode_base64(content)
+    else:
+        filename, mimetype = os.path.basename(attachment), None
+        payload = _encode_file(attachment)
+    mimetype = mimetype or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    part = MIMEBase(*mimetype.split("/", 1))
+    if charset and part.get_content_maintype() == "text":
+        part.set_param("charset", charset)
+    part.set_payload(payload.decode("ascii"))
+    part["Content-Transfer-Encoding"] = "base64"
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        filename = ("utf-8", "", filename)
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    return part
+
+
+def _chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable``.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DeliveryPool(object):
+    """
+    Runs deliveries on worker threads, so that network waits overlap with
+    rendering and saving the next recipients. ``submit`` blocks while
+    ``backlog`` deliveries are waiting, which keeps memory bounded when
+    delivery is the slowest stage. With no threads deliveries run right
+    away in the calling thread.
+
+    A failed delivery only affects its own recipient: the backends log,
+    signal and catch errors per recipient. Anything escaping a backend is
+    logged here, it is not propagated.
+    """
+
+    def __init__(self, threads=None, backlog=None):
+        self.queue = Queue(maxsize=DELIVERY_BACKLOG if backlog is None else backlog)
+        self.threads = [threading.Thread(target=self.work, name="notification-delivery-%d" % i)
+                        for i in range(DELIVERY_THREADS if threads is None else threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def run(func, args):
+        try:
+            func(*args)
+        except Exception:
+            notifications_logger.exception("ERROR:DELIVERY: %s failed" % getattr(func, "__name__", func))
+
+    def submit(self, func, *args):
+        if self.threads:
+            self.queue.put((func, args))
+        else:
+            self.run(func, args)
+
+    def work(self):
+        try:
+            while True:
+                delivery = self.queue.get()
+                if delivery is None:
+                    break
+                self.run(*delivery)
+        finally:
+            # the backends keep their connections per thread, and signal
+            # receivers may have opened a database connection in this one
+            for backend in list(_backends.values()):
+                backend.close()
+            connections.close_all()
+
+    def close(self):
+        """
+        Waits for the submitted deliveries to finish.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class RenderPool(object):
+    """
+    Renders notices in ``processes`` worker processes, so that rendering and
+    CSS inlining of a large send use more than one core. Recipients are
+    sharded across the processes, which render from a pickled copy of the
+    context and return the rendered strings. Batches of fewer than
+    RENDER_MIN_RECIPIENTS, and all batches when there are no processes, are
+    rendered in the calling process.
+
+    The processes are started on first use from a forkserver, never forked
+    from the caller, whose delivery threads could be holding locks, and are
+    kept for the life of the process, see get_render_pool. They need Python
+    3.7 or later, a platform with ``fork`` and DJANGO_SETTINGS_MODULE to set
+    Django up. Templates rendered this way must not query the database.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = RENDER_PROCESSES if processes is None else processes
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        try:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("forkserver"),
+                                       initializer=_init_render_process)
+        except (ImportError, TypeError, ValueError):
+            raise ImproperlyConfigured("NOTIFICATION_RENDER_PROCESSES needs Python 3.7 or later and fork()")
+
+    def get_executor(self):
+        with self.lock:
+            # a forked child, e.g. a web server worker, cannot use the
+            # processes of its parent
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = self.start()
+                self.pid = os.getpid()
+            return self.executor
+
+    def render(self, jobs):
+        """
+        Returns the ``(messages, subject, body)`` of every job, in order.
+        """
+        if not self.processes or len(jobs) < RENDER_MIN_RECIPIENTS:
+            return _render_shard(jobs)
+        executor = self.get_executor()
+        # a few shards per process keep them busy when shards take unequal time
+        size = -(-len(jobs) // (self.processes * 4))
+        shards = [jobs[start:start + size] for start in range(0, len(jobs), size)]
+        try:
+            return [rendered for shard in executor.map(_render_shard, shards) for rendered in shard]
+        except BrokenProcessPool:
+            # a process that died takes the whole executor with it, the next
+            # send starts new ones
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown()
+            self.executor = None
+
+
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+
+def get_render_pool(processes=None):
+    """
+    Returns the RenderPool of this process for ``processes`` processes
+    (RENDER_PROCESSES by default). Its processes are started once and shared
+    by every send_now call, and shut down when the interpreter exits.
+    """
+    processes = RENDER_PROCESSES if processes is None else processes
+    with _render_pools_lock:
+        if processes not in _render_pools:
+            _render_pools[processes] = RenderPool(processes)
+            atexit.register(_render_pools[processes].close)
+        return _render_pools[processes]
+
+
 def send_now(users, label, extra_context=None, on_site=True, sender=None, attachments=[], \
-             obj_instance=None, force_send=False):
+             obj_instance=None, force_send=False, dedupe_key=None, dedupe=True):
     """
     Creates a new notice.
 
@@ -331,6 +1184,16 @@ def send_now(users, label, extra_context=None, on_site=True, sender=None, attach
 
     You can pass in on_site=False to prevent the notice emitted from being
     displayed on the site.
+
+    Repeats within the notice type's dedupe window are dropped, see
+    drop_duplicates. Pass dedupe=False to skip that check.
+
+    Emails and text messages are delivered by a DeliveryPool, see
+    NOTIFICATION_DELIVERY_THREADS. send_now returns once all of them are
+    delivered.
+
+    ``attachments`` are encoded once for all recipients, see
+    prepare_attachment for what they may be.
     """
     if extra_context is None:
         extra_context = {}
@@ -341,39 +1204,96 @@ def send_now(users, label, extra_context=None, on_site=True, sender=None, attach
 
     current_language = get_language()
 
+    # on-site notices are the Notice rows themselves, the other media get
+    # them delivered by their backends
+    backends = OrderedDict((medium, get_backend(medium)) for medium, label, sensitivity, backend in MEDIA
+                           if medium != "2")
+
     formats = (
         'short.txt',
         'full.txt',
         'notice.html',
         'full.html',
-        'sms.txt',
     )
+    formats += tuple(sorted(set(backend.format for backend in backends.values() if backend.format) - set(formats)))
 
-    from django.db import connection
+    attachments = [prepare_attachment(attachment) for attachment in attachments]
 
-    for user in users:
+    if isinstance(users, Audience):
+        users = users.iterator(SEND_CHUNK_SIZE)
+    elif isinstance(users, QuerySet):
+        users = users.iterator()
 
-        should_send_email = user.is_active and (
-                    user.email and force_send or should_send(user, notice_type, "1", obj_instance))
-        should_send_sms = user.userprofile.sms and user.is_active and should_send(user, notice_type, "3", obj_instance)
+    renderer = get_render_pool()
+    with DeliveryPool() as pool:
+        for chunk in _chunked(users, SEND_CHUNK_SIZE):
+            _send_chunk(renderer, pool, chunk, notice_type, label, extra_context, sender, attachments,
+                        obj_instance, force_send, dedupe_key, dedupe, current_site, formats, backends,
+                        current_language)
+
+    # reset environment to original language
+    activate(current_language)
+
+
+def _send_chunk(renderer, pool, chunk, notice_type, label, extra_context, sender, attachments,
+                obj_instance, force_send, dedupe_key, dedupe, current_site, formats, backends,
+                current_language):
+    """
+    Resolves the notices of one chunk of send_now's recipients, renders them
+    with ``renderer``, saves them and hands their deliveries to ``pool``, in
+    batches for each medium's backend.
+    """
+    keys = None
+    if dedupe:
+        keys = unsent_dedupe_keys([user.pk for user in chunk], label, extra_context, dedupe_key)
+        if keys is not None:
+            unsent = set(keys.values())
+            chunk = [user for user in chunk if user.pk in unsent]
+            if not chunk:
+                return
+
+    # fetch the settings of the whole chunk, and whatever the backends need,
+    # up front instead of querying for them once per recipient
+    notice_settings = get_notification_settings(chunk, [notice_type], list(backends))
+    for backend in backends.values():
+        backend.prefetch(chunk)
+    digest_frequencies = dict(NoticeDigestSetting.objects.filter(
+        user__in=chunk, notice_type=notice_type).values_list("user_id", "frequency"))
+
+    recipients = []
+    jobs = []
+    for user in chunk:
+        # where the notice goes, by medium
+        addresses = {}
+        if user.is_active:
+            for medium, backend in backends.items():
+                to = backend.address(user)
+                if to and (medium == "1" and force_send or should_send(
+                        user, notice_type, medium, obj_instance, notice_settings[(user.pk, notice_type.pk, medium)])):
+                    addresses[medium] = to
         # disabled check for on_site for now since we are not using it
         # on_site = should_send(user, notice_type, "2", obj_instance) #On-site display
         on_site = False
 
-        if not (should_send_email or should_send_sms or on_site):
+        # the email goes out with the user's next digest instead
+        digest = "1" in addresses and not force_send and user.pk in digest_frequencies
+        if digest:
+            del addresses["1"]
+
+        if not (addresses or digest or on_site):
             continue
 
-        recipients = []
         # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
+        # NOTIFICATION_LANGUAGE_MODULE setting, falling back to the language
+        # send_now was called in rather than whichever recipient's language
+        # was activated last
         try:
-            language = get_notification_language(user)
+            language = get_notification_language(user) or current_language
         except LanguageStoreNotAvailable:
-            language = None
+            language = current_language
 
-        if language is not None:
-            # activate the user's language
-            activate(language)
+        # activate the user's language
+        activate(language)
 
         # update context with user specific translations
         context = {
@@ -385,54 +1305,81 @@ def send_now(users, label, extra_context=None, on_site=True, sender=None, attach
         }
         context.update(extra_context)
 
-        # get prerendered format messages
-        messages = get_formatted_messages(formats, label, context)
-        context['message'] = messages['short.txt']
-
-        # Strip newlines from subject
-        subject = ''.join(render_to_string('notification/email_subject.txt', context).splitlines())
-
-        context['message'] = messages['full.txt']
-        body = render_to_string('notification/email_body.txt', context)
-        body = pynliner.fromString(body)
-
-        notice = Notice.objects.create(recipient=user, message=messages['notice.html'],
-                                       notice_type=notice_type, on_site=on_site, sender=sender)
-
-        if should_send_email:  # Email
-            recipients.append(user.email)
-            # send empty "plain text" data
-            msg = EmailMultiAlternatives(subject, "", settings.DEFAULT_FROM_EMAIL, recipients)
-            # attach html data as alternative
-            msg.attach_alternative(body, "text/html")
-            for attachment in attachments:
-                msg.attach(attachment)
-            try:
-                msg.send()
-                email_sent.send(sender=Notice, user=user, notice_type=notice_type, obj=obj_instance)
-                notifications_logger.info(
-                    "SUCCESS:EMAIL:%s: data=(notice_type=%s, subject=%s)" % (user, notice_type, subject))
-            except:
-                notifications_logger.exception(
-                    "ERROR:EMAIL:%s: data=(notice_type=%s, subject=%s)" % (user, notice_type, subject))
-
-        if should_send_sms:
-            try:
-                rc = TwilioRestClient(TWILIO_ACCOUNT_SID, TWILIO_ACCOUNT_TOKEN)
-                rc.api.v2010.messages.create(
-                    to=user.userprofile.sms,
-                    from_=TWILIO_CALLER_ID,
-                    body=messages['sms.txt'],
-                )
-                sms_sent.send(sender=Notice, user=user, notice_type=notice_type, obj=obj_instance)
-                notifications_logger.info(
-                    "SUCCESS:SMS:%s: data=(notice_type=%s, msg=%s)" % (user, notice_type, messages['sms.txt']))
-            except:
-                notifications_logger.exception(
-                    "ERROR:SMS:%s: data=(notice_type=%s, msg=%s)" % (user, notice_type, messages['sms.txt']))
-
-    # reset environment to original language
-    activate(current_language)
+        recipients.append((user, addresses, on_site, digest))
+        jobs.append((label, formats, language, context, "1" in addresses))
+
+    rendered = list(zip(recipients, renderer.render(jobs)))
+    with transaction.atomic():
+        if keys is not None:
+            # recorded in the transaction saving the notices, so that a send
+            # failing before they are saved is not dropped as a duplicate
+            # when it is retried
+            allowed = record_dedupe_keys(keys)
+            rendered = [(recipient, result) for recipient, result in rendered if recipient[0].pk in allowed]
+
+        notices = []
+        digest_items = []
+        deliveries = dict((medium, []) for medium in backends)
+        outbox = []
+        for (user, addresses, on_site, digest), (messages, subject, body) in rendered:
+            notices.append(Notice(recipient=user, message=messages['notice.html'],
+                                  notice_type=notice_type, on_site=on_site, sender=sender))
+            if digest:
+                digest_items.append(DigestItem(user=user, notice_type=notice_type,
+                                               frequency=digest_frequencies[user.pk],
+                                               subject=messages['short.txt'], message=messages['full.txt']))
+            for medium, to in addresses.items():
+                if medium == "1":
+                    delivery = Delivery(user, notice_type, to, subject, body, attachments, obj_instance)
+                else:
+                    delivery = Delivery(user, notice_type, to, messages['short.txt'],
+                                        messages[backends[medium].format], (), obj_instance)
+                # attachments are not stored in the outbox, such emails are
+                # always sent right away
+                if USE_OUTBOX and not delivery.attachments:
+                    outbox.append(OutboxMessage(medium=medium, recipient=user, notice_type=notice_type, to=to,
+                                                subject=delivery.subject if medium == "1" else "",
+                                                body=delivery.body, obj=obj_instance))
+                else:
+                    deliveries[medium].append(delivery)
+
+        if MESSAGE_STORE:
+            bodies = get_notice_messages(set(notice.message for notice in notices))
+            for notice in notices:
+                notice.body = bodies[notice.message]
+                notice.message = ""
+        _save_notices(notices)
+        DigestItem.objects.bulk_create(digest_items)
+        OutboxMessage.objects.bulk_create(outbox)
+
+    inbox_changed(notice.recipient_id for notice in notices)
+
+    for medium, backend in backends.items():
+        for batch in _chunked(deliveries[medium], backend.batch_size):
+            pool.submit(backend.deliver, batch)
+
+
+def _save_notices(notices):
+    """
+    Saves ``notices`` with one bulk_create and sends ``post_save`` for them,
+    which bulk_create does not do itself. When ``post_save`` has receivers
+    for Notice and the database does not return the primary keys of bulk
+    inserted rows, such as SQLite and MySQL, the notices are saved one by one
+    instead, so that the receivers still get saved notices.
+    """
+    features = connections[router.db_for_write(Notice)].features
+    returns_pks = getattr(features, "can_return_rows_from_bulk_insert",
+                          getattr(features, "can_return_ids_from_bulk_insert", False))
+    if not returns_pks and models.signals.post_save.has_listeners(Notice):
+        for notice in notices:
+            # Model.save sends post_save; the caller changes the inboxes of
+            # the whole chunk at once rather than Notice.save once per notice
+            super(Notice, notice).save(force_insert=True)
+        return
+    Notice.objects.bulk_create(notices)
+    for notice in notices:
+        models.signals.post_save.send(sender=Notice, instance=notice, created=True, raw=False,
+                                      using=notice._state.db, update_fields=None)
 
 
 def send(*args, **kwargs):
@@ -445,33 +1392,80 @@ def send(*args, **kwargs):
     queue_flag = kwargs.pop("queue", False)
     now_flag = kwargs.pop("now", False)
     assert not (queue_flag and now_flag), "'queue' and 'now' cannot both be True."
-    if queue_flag:
+    if kwargs.get("eta") is not None:
+        # scheduled notices can only be sent through the queue
+        assert not now_flag, "'eta' cannot be used with 'now'."
+        queue_flag = True
+    if queue_flag or (QUEUE_ALL and not now_flag):
         return queue(*args, **kwargs)
-    elif now_flag:
-        return send_now(*args, **kwargs)
-    else:
-        if QUEUE_ALL:
-            return queue(*args, **kwargs)
-        else:
-            return send_now(*args, **kwargs)
+    # priority only orders the queue
+    kwargs.pop("priority", None)
+    kwargs.pop("eta", None)
+    return send_now(*args, **kwargs)
 
 
-def queue(users, label, extra_context=None, on_site=True, sender=None):
+def queue(users, label, extra_context=None, on_site=True, sender=None, dedupe_key=None,
+          priority=PRIORITY_MEDIUM, eta=None):
     """
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
     the webserver.
+
+    Queued notices are emitted by ``priority`` (PRIORITY_HIGH first), and not
+    before ``eta`` if one is given.
+
+    Duplicates are dropped here, before queueing, rather than when the queue
+    is emitted (see drop_duplicates).
+
+    ``users`` can also be an Audience, e.g. ``UserAudience(is_active=True)``.
+    It is stored as it is, in a single batch, and only expanded into users
+    when the queue is emitted; duplicates are dropped then.
     """
     if extra_context is None:
         extra_context = {}
+    not_before = eta or timezone.now()
+    if isinstance(users, Audience):
+        NoticeQueueBatch.objects.create(
+            pickled_data=NoticeQueueBatch.encode({
+                "audience": users,
+                # pk of the last user emitted to, so an interrupted batch
+                # resumes where it stopped
+                "after": None,
+                "label": label,
+                "extra_context": extra_context,
+                "on_site": on_site,
+                "sender": sender,
+                "dedupe_key": dedupe_key,
+            }),
+            priority=priority, not_before=not_before, label=label)
+        return
     if isinstance(users, QuerySet):
-        users = [row["pk"] for row in users.values("pk")]
+        user_ids = users.values_list("pk", flat=True).iterator()
     else:
-        users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, on_site, sender))
-    NoticeQueueBatch(pickled_data=pickle.dumps(notices).encode("base64")).save()
+        user_ids = (user.pk for user in users)
+
+    # stream the recipients into fixed size batches so memory use does not
+    # depend on the size of the audience
+    with transaction.atomic():
+        batches = []
+        for chunk in _chunked(user_ids, QUEUE_BATCH_SIZE):
+            allowed = drop_duplicates(chunk, label, extra_context, dedupe_key)
+            chunk = [user_id for user_id in chunk if user_id in allowed]
+            if not chunk:
+                continue
+            batches.append(NoticeQueueBatch(
+                pickled_data=NoticeQueueBatch.encode({
+                    "users": chunk,
+                    "label": label,
+                    "extra_context": extra_context,
+                    "on_site": on_site,
+                    "sender": sender,
+                }),
+                priority=priority, not_before=not_before, label=label, recipient_count=len(chunk)))
+            if len(batches) >= QUEUE_BULK_SIZE:
+                NoticeQueueBatch.objects.bulk_create(batches)
+                batches = []
+        NoticeQueueBatch.objects.bulk_create(batches)
 
 
 class ObservedItemManager(models.Manager):
@@ -490,6 +1484,46 @@ class ObservedItemManager(models.Manager):
         observed_item = self.get(content_type=content_type, object_id=observed.id, user=observer, signal=signal)
         return observed_item
 
+    def delete_duplicates(self):
+        """
+        Deletes all but the oldest of the ObservedItems that have the same
+        object, signal and user, and returns how many were deleted.
+        """
+        fields = ("content_type", "object_id", "signal", "user")
+        duplicates = self.order_by().values(*fields).annotate(keep=Min("pk"), count=Count("pk")).filter(count__gt=1)
+        deleted = 0
+        for row in list(duplicates):
+            deleted += self.filter(**dict((field, row[field]) for field in fields)).exclude(pk=row["keep"]).delete()[0]
+        return deleted
+
+
+OBSERVED_TYPES_KEY = "notification:observed_types"
+
+
+def get_observed_types():
+    """
+    Returns the set of ``(content_type_id, signal)`` pairs that have at least
+    one observer. It is cached, so checking whether anybody observes a model
+    costs no query.
+    """
+    cache = caches[CACHE]
+    observed_types = cache.get(OBSERVED_TYPES_KEY)
+    if observed_types is None:
+        observed_types = frozenset(ObservedItem.objects.order_by().values_list("content_type", "signal").distinct())
+        cache.set(OBSERVED_TYPES_KEY, observed_types, OBSERVED_TYPES_TIMEOUT)
+    return observed_types
+
+
+def observed_types_changed():
+    """
+    Drops the cached set of observed types. It is dropped again after the
+    current transaction commits, in case it was rebuilt meanwhile by a
+    process that could not see the change yet.
+    """
+    cache = caches[CACHE]
+    cache.delete(OBSERVED_TYPES_KEY)
+    transaction.on_commit(lambda: cache.delete(OBSERVED_TYPES_KEY))
+
 
 class ObservedItem(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_('user'))
@@ -503,7 +1537,7 @@ class ObservedItem(models.Model):
     added = models.DateTimeField(_('added'), default=timezone.now)
 
     # the signal that will be listened to send the notice
-    signal = models.TextField(verbose_name=_('signal'))
+    signal = models.CharField(_('signal'), max_length=100)
 
     objects = ObservedItemManager()
 
@@ -511,6 +1545,17 @@ class ObservedItem(models.Model):
         ordering = ['-added']
         verbose_name = _('observed item')
         verbose_name_plural = _('observed items')
+        # its index also serves all_for and get_for
+        unique_together = [('content_type', 'object_id', 'signal', 'user')]
+
+    def save(self, *args, **kwargs):
+        super(ObservedItem, self).save(*args, **kwargs)
+        observed_types_changed()
+
+    def delete(self, *args, **kwargs):
+        result = super(ObservedItem, self).delete(*args, **kwargs)
+        observed_types_changed()
+        return result
 
     def send_notice(self, extra_context=None):
         if extra_context is None:
@@ -526,9 +1571,9 @@ def observe(observed, observer, notice_type_label, signal='post_save'):
     To be used by applications to register a user as an observer for some object.
     """
     notice_type = NoticeType.objects.get(label=notice_type_label)
-    observed_item = ObservedItem(user=observer, observed_object=observed,
-                                 notice_type=notice_type, signal=signal)
-    observed_item.save()
+    observed_item, created = ObservedItem.objects.get_or_create(
+        user=observer, content_type=ContentType.objects.get_for_model(observed), object_id=observed.pk,
+        signal=signal, defaults={"notice_type": notice_type})
     return observed_item
 
 
@@ -540,18 +1585,108 @@ def stop_observing(observed, observer, signal='post_save'):
     observed_item.delete()
 
 
+def _observed_lookup(observed_objects):
+    """
+    Returns a Q matching the ObservedItems of the given objects, and the
+    objects by ``(content_type_id, object_id)``.
+    """
+    objects = {}
+    object_ids = {}
+    for observed in observed_objects:
+        content_type = ContentType.objects.get_for_model(observed)
+        objects[(content_type.pk, observed.pk)] = observed
+        object_ids.setdefault(content_type.pk, []).append(observed.pk)
+    lookup = Q(pk__in=[])
+    for content_type_id, ids in object_ids.items():
+        lookup |= Q(content_type=content_type_id, object_id__in=ids)
+    return lookup, objects
+
+
+def observe_many(observed_objects, observers, notice_type_label, signal='post_save'):
+    """
+    Makes every user in ``observers`` observe every object in
+    ``observed_objects``, with a single insert. Pairs that are observed
+    already are left alone. Returns the new ObservedItems.
+    """
+    observers = list(observers)
+    lookup, objects = _observed_lookup(observed_objects)
+    if not (objects and observers):
+        return []
+    notice_type = NoticeType.objects.get(label=notice_type_label)
+    existing = set(ObservedItem.objects.filter(lookup, user__in=observers, signal=signal).values_list(
+        "content_type", "object_id", "user"))
+    observed_items = [
+        ObservedItem(user=observer, content_type_id=content_type_id, object_id=object_id,
+                     notice_type=notice_type, signal=signal)
+        for content_type_id, object_id in objects
+        for observer in observers
+        if (content_type_id, object_id, observer.pk) not in existing
+    ]
+    ObservedItem.objects.bulk_create(observed_items)
+    if observed_items:
+        observed_types_changed()
+    return observed_items
+
+
+def stop_observing_many(observed_objects, observers, signal='post_save'):
+    """
+    Makes every user in ``observers`` stop observing the objects in
+    ``observed_objects``, with a single delete.
+    """
+    lookup, objects = _observed_lookup(observed_objects)
+    if objects:
+        ObservedItem.objects.filter(lookup, user__in=list(observers), signal=signal).delete()
+        observed_types_changed()
+
+
+def observing_map(observed_objects, observer, signal='post_save'):
+    """
+    Returns a dictionary telling for each of ``observed_objects`` whether
+    ``observer`` observes it, with a single query. Use it instead of calling
+    is_observing once per object, e.g. for the watch toggles of a list.
+    """
+    lookup, objects = _observed_lookup(observed_objects)
+    observing = dict((observed, False) for observed in objects.values())
+    if isinstance(observer, AnonymousUser) or not objects:
+        return observing
+    for key in ObservedItem.objects.filter(lookup, user=observer, signal=signal).values_list(
+            "content_type", "object_id"):
+        observing[objects[key]] = True
+    return observing
+
+
 def send_observation_notices_for(observed, signal='post_save', extra_context=None):
     """
     Send a notice for each registered user about an observed object.
     """
     if extra_context is None:
         extra_context = {}
-    observed_items = ObservedItem.objects.all_for(observed, signal)
+    observed_items = ObservedItem.objects.all_for(observed, signal).select_related("user", "notice_type")
+    # one send per notice type rather than one per observer
+    observers = {}
     for observed_item in observed_items:
-        observed_item.send_notice(extra_context)
+        observers.setdefault(observed_item.notice_type.label, []).append(observed_item.user)
+    context = dict(extra_context, observed=observed)
+    for label, users in observers.items():
+        send(users, label, context)
     return observed_items
 
 
+def queue_observation_notices_for(observed, signal='post_save', extra_context=None):
+    """
+    Queues a notice for each registered user about an observed object. Only
+    the notice types of the observers are looked up; the observers
+    themselves are looked up by ``emit_notices``, see ObserverAudience.
+    """
+    if extra_context is None:
+        extra_context = {}
+    labels = ObservedItem.objects.all_for(observed, signal).order_by().values_list(
+        "notice_type__label", flat=True).distinct()
+    context = dict(extra_context, observed=observed)
+    for label in labels:
+        queue(ObserverAudience(observed, signal, label), label, context)
+
+
 def is_observing(observed, observer, signal='post_save'):
     if isinstance(observer, AnonymousUser):
         return False
@@ -560,9 +1695,17 @@ def is_observing(observed, observer, signal='post_save'):
         return True
     except ObservedItem.DoesNotExist:
         return False
-    except ObservedItem.MultipleObjectsReturned:
-        return True
 
 
 def handle_observations(sender, instance, *args, **kw):
-    send_observation_notices_for(instance)
+    # most saved objects are of models nobody observes, skip those without a
+    # query
+    if (ContentType.objects.get_for_model(instance).pk, 'post_save') not in get_observed_types():
+        return
+    # notify after the save is committed, so observers are never told about
+    # a change that is rolled back, and the transaction is not held open
+    # while the notices go out
+    if QUEUE_OBSERVATIONS:
+        transaction.on_commit(lambda: queue_observation_notices_for(instance), using=instance._state.db)
+    else:
+        transaction.on_commit(lambda: send_observation_notices_for(instance), using=instance._state.db)
@@ -0,0 +1,44 @@
+"""
+Renders notices, in the calling process or in the processes of a
+RenderPool. The processes import this module before Django is set up, so it
+must not import models at module level.
+"""
+from __future__ import absolute_import
+
+
+def init_process():
+    # the processes start from a fresh interpreter rather than a copy of the
+    # caller, which may be running delivery threads
+    import django
+    django.setup()
+
+
+def render_notice(job):
+    """
+    Renders the notice formats, and the email subject and body if asked to,
+    for one recipient. Only takes and returns picklable values, so that it
+    can run in a RenderPool process.
+    """
+    import pynliner
+    from django.template.loader import render_to_string
+    from django.utils.translation import activate
+    from notification.models import get_formatted_messages
+
+    label, formats, language, context, render_email = job
+    activate(language)
+    messages = get_formatted_messages(formats, label, context)
+    subject = body = None
+    if render_email:
+        context['message'] = messages['short.txt']
+
+        # Strip newlines from subject
+        subject = ''.join(render_to_string('notification/email_subject.txt', context).splitlines())
+
+        context['message'] = messages['full.txt']
+        body = render_to_string('notification/email_body.txt', context)
+        body = pynliner.fromString(body)
+    return messages, subject, body
+
+
+def render_shard(jobs):
+    return [render_notice(job) for job in jobs]
@@ -1,6 +1,7 @@
 from django.conf.urls import url
 
-from notification.views import notices, mark_all_seen, feed_for_user, single, notice_settings
+from notification.views import notices, mark_all_seen, feed_for_user, single, notice_settings, notice_stream, \
+    notices_api
 
 urlpatterns = [
     url(r'^$', notices, name="notification_notices"),
@@ -8,4 +9,6 @@ urlpatterns = [
     url(r'^(\d+)/$', single, name="notification_notice"),
     url(r'^feed/$', feed_for_user, name="notification_feed_for_user"),
     url(r'^mark_all_seen/$', mark_all_seen, name="notification_mark_all_seen"),
+    url(r'^stream/$', notice_stream, name="notification_notice_stream"),
+    url(r'^api/$', notices_api, name="notification_notices_api"),
 ]
@@ -1,8 +1,16 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.contrib.syndication.views import Feed
-from django.http import Http404, HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, \
+    HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_http_methods
 from notification.decorators import (
     basic_auth_required,
     simple_basic_auth_callback,
@@ -10,6 +18,30 @@ from notification.decorators import (
 from notification.feeds import NoticeUserFeed
 from notification.models import *
 
+# how long a notice stream stays open before the client has to reconnect,
+# how often it checks for changes and how often it sends a keep alive, in
+# seconds
+STREAM_TIMEOUT = getattr(settings, "NOTIFICATION_STREAM_TIMEOUT", 30)
+STREAM_POLL_INTERVAL = getattr(settings, "NOTIFICATION_STREAM_POLL_INTERVAL", 1)
+STREAM_KEEPALIVE = getattr(settings, "NOTIFICATION_STREAM_KEEPALIVE", 15)
+# page sizes of the JSON inbox
+API_PAGE_SIZE = getattr(settings, "NOTIFICATION_API_PAGE_SIZE", 20)
+API_MAX_PAGE_SIZE = getattr(settings, "NOTIFICATION_API_MAX_PAGE_SIZE", 100)
+
+# the fields the JSON inbox can return and the columns they are read from
+API_FIELDS = {
+    "id": ("pk",),
+    "notice_type": ("notice_type__label",),
+    "message": ("message", "body__data", "body__compressed"),
+    "added": ("added",),
+    "unseen": ("unseen",),
+    "archived": ("archived",),
+    "on_site": ("on_site",),
+    "sender": ("sender_id",),
+    "url": ("pk",),
+}
+API_DEFAULT_FIELDS = ("id", "notice_type", "message", "added", "unseen", "url")
+
 
 @basic_auth_required(realm='Notices Feed', callback_func=simple_basic_auth_callback)
 def feed_for_user(request):
@@ -17,9 +49,10 @@ def feed_for_user(request):
     An atom feed for all unarchived :model:`notification.Notice`s for a user.
     """
     url = "feed/%s" % request.user.username
-    return Feed(request, url, {
-        "feed": NoticeUserFeed,
-    })
+    feedgen = NoticeUserFeed(url, request.path).get_feed(request.user.username)
+    response = HttpResponse(content_type="%s; charset=utf-8" % feedgen.mime_type)
+    feedgen.write(response, "utf-8")
+    return response
 
 
 @login_required
@@ -35,7 +68,9 @@ def notices(request):
             A list of :model:`notification.Notice` objects that are not archived
             and to be displayed on the site.
     """
-    notices = Notice.objects.notices_for(request.user, on_site=True)
+    # repeat views are served from the cache until the inbox changes
+    notices = cached_for_inbox(request.user, "notices",
+                               lambda: list(Notice.objects.notices_for(request.user, on_site=True)))
 
     return render(request, "notification/notices.html", {"notices": notices})
 
@@ -61,23 +96,25 @@ def notice_settings(request):
             variable called ``form_label``, whose valid value is ``on``.
     """
     notice_types = NoticeType.objects.all()
+    all_settings = get_notification_settings(
+        [request.user], notice_types, [medium_id for medium_id, medium_display in NOTICE_MEDIA])
+    changed = {True: [], False: []}
     settings_table = []
     for notice_type in notice_types:
         settings_row = []
         for medium_id, medium_display in NOTICE_MEDIA:
             form_label = "%s_%s" % (notice_type.label, medium_id)
-            setting = get_notification_setting(request.user, notice_type, medium_id)
+            setting = all_settings[(request.user.pk, notice_type.pk, medium_id)]
             if request.method == "POST":
-                if request.POST.get(form_label) == "on":
-                    if not setting.send:
-                        setting.send = True
-                        setting.save()
-                else:
-                    if setting.send:
-                        setting.send = False
-                        setting.save()
+                send = request.POST.get(form_label) == "on"
+                if setting.send != send:
+                    setting.send = send
+                    changed[send].append(setting.pk)
             settings_row.append((form_label, setting.send))
         settings_table.append({"notice_type": notice_type, "cells": settings_row})
+    for send, pks in changed.items():
+        if pks:
+            NoticeSetting.objects.filter(pk__in=pks).update(send=send)
 
     notice_settings = {
         "column_headers": [medium_display for medium_id, medium_display in NOTICE_MEDIA],
@@ -108,7 +145,7 @@ def single(request, id, mark_seen=True):
             If ``True``, mark the notice as seen if it isn't
             already.  Do nothing if ``False``.  Default: ``True``.
     """
-    notice = get_object_or_404(Notice, id=id)
+    notice = get_object_or_404(Notice.objects.select_related("body"), id=id)
     if request.user == notice.recipient:
         if mark_seen and notice.unseen:
             notice.unseen = False
@@ -182,7 +219,162 @@ def mark_all_seen(request):
     ``HttpResponseRedirect`` when complete.
     """
 
-    for notice in Notice.objects.notices_for(request.user, unseen=True):
-        notice.unseen = False
-        notice.save()
+    Notice.objects.notices_for(request.user, unseen=True).update(unseen=False)
+    inbox_changed([request.user.pk])
     return HttpResponseRedirect(reverse("notification_notices"))
+
+
+def _event(event, data, id=None):
+    lines = ["event: %s" % event]
+    if id is not None:
+        lines.append("id: %s" % id)
+    lines.append("data: %s" % json.dumps(data, cls=DjangoJSONEncoder))
+    return "\n".join(lines) + "\n\n"
+
+
+def _notice_events(user, last_id):
+    version = None
+    keepalive = deadline = time.time()
+    deadline += STREAM_TIMEOUT
+    while time.time() < deadline:
+        current = get_inbox_version(user)
+        if current != version:
+            version = current
+            notices = Notice.objects.notices_for(user, on_site=True)
+            if last_id is None:
+                # a new connection only hears about notices from now on
+                last_id = notices.order_by("-pk").values_list("pk", flat=True).first() or 0
+            for notice in notices.filter(pk__gt=last_id).order_by("pk"):
+                last_id = notice.pk
+                yield _event("notice", {
+                    "id": notice.pk,
+                    "notice_type": notice.notice_type_id,
+                    "message": notice.message,
+                    "added": notice.added,
+                    "url": notice.get_absolute_url(),
+                }, id=notice.pk)
+            counts = Notice.objects.counts_for(user, on_site=True)
+            yield _event("unseen", {
+                "count": sum(count["unseen"] for count in counts.values()),
+                "counts": dict((label, count["unseen"]) for label, count in counts.items()),
+            })
+            keepalive = time.time()
+        elif time.time() - keepalive >= STREAM_KEEPALIVE:
+            yield ": keepalive\n\n"
+            keepalive = time.time()
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
+@login_required
+def notice_stream(request):
+    """
+    A Server-Sent Events stream of the requesting user's new on site notices
+    and unseen count, for use with ``EventSource``.
+
+    A ``notice`` event is sent for every new notice and an ``unseen`` event
+    with the unseen count whenever the inbox changes. The stream only checks
+    the inbox version in the cache while nothing changes, and closes after
+    ``NOTIFICATION_STREAM_TIMEOUT`` seconds; ``EventSource`` reconnects with
+    the ``Last-Event-ID`` header, so no notice is missed in between.
+    """
+    last_id = request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("last_event_id")
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    response = StreamingHttpResponse(_notice_events(request.user, last_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # keep nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _api_value(field, row):
+    if field == "message":
+        if row["body__data"] is not None:
+            return NoticeMessage.decode(row["body__data"], row["body__compressed"])
+        return row["message"]
+    if field == "url":
+        return reverse("notification_notice", args=[str(row["pk"])])
+    return row[API_FIELDS[field][0]]
+
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def notices_api(request):
+    """
+    The requesting user's notices as JSON, newest first.
+
+    Query arguments:
+
+        fields
+            Comma separated names out of ``API_FIELDS`` to return for each
+            notice. Default: ``API_DEFAULT_FIELDS``.
+
+        before
+            Only return notices with a lower id, pass the ``next`` value of
+            the previous page to get the next one.
+
+        limit
+            The number of notices to return, at least 1 and at most
+            ``API_MAX_PAGE_SIZE``.
+
+        unseen, archived
+            ``1`` or ``0`` to filter on them. Archived notices are left out
+            unless ``archived`` is given.
+
+    A POST with a comma separated list of notice ids in ``seen`` marks those
+    notices seen before the page is returned.
+
+    GET responses carry an ETag derived from the inbox version, so a client
+    repeating a request with ``If-None-Match`` gets a 304 response without
+    the notices being queried while the inbox is unchanged. There is no ETag
+    when the cache does not keep inbox versions.
+    """
+    params = request.GET
+    try:
+        fields = [field for field in params.get("fields", ",".join(API_DEFAULT_FIELDS)).split(",") if field]
+        if not fields or set(fields) - set(API_FIELDS):
+            raise ValueError("fields")
+        limit = min(int(params.get("limit", API_PAGE_SIZE)), API_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit")
+        before = int(params["before"]) if params.get("before") else None
+        seen = [int(pk) for pk in request.POST.get("seen", "").split(",") if pk]
+    except ValueError:
+        return HttpResponseBadRequest("invalid fields, limit, before or seen argument")
+
+    if seen:
+        Notice.objects.filter(recipient=request.user, pk__in=seen, unseen=True).update(unseen=False)
+        inbox_changed([request.user.pk])
+
+    etag = None
+    # without a version the cache keeps, nothing tells whether the inbox
+    # changed since the client's copy
+    version = get_inbox_version(request.user, stored_only=True) if request.method == "GET" else None
+    if version is not None:
+        etag = quote_etag(hashlib.md5(("%s:%s" % (version, request.get_full_path())).encode("utf-8")).hexdigest())
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            return HttpResponseNotModified()
+
+    notices = Notice.objects.filter(recipient=request.user)
+    for flag in ("unseen", "archived"):
+        if params.get(flag) in ("0", "1"):
+            notices = notices.filter(**{flag: params[flag] == "1"})
+    if "archived" not in params:
+        notices = notices.filter(archived=False)
+    if before is not None:
+        notices = notices.filter(pk__lt=before)
+    columns = set(["pk"])
+    for field in fields:
+        columns.update(API_FIELDS[field])
+    rows = list(notices.order_by("-pk").values(*columns)[:limit])
+
+    response = JsonResponse({
+        "notices": [dict((field, _api_value(field, row)) for field in fields) for row in rows],
+        "next": rows[-1]["pk"] if len(rows) == limit else None,
+    })
+    if etag is not None:
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+    return response